@@ -0,0 +1,67 @@
+# Times the day route solvers on random days around a property
+# Usage: python benchmark.py [number of days] [latency budget per day in ms]
+# Note that the greedy+local column includes ROUTE_IMPROVEMENT_BUDGET of local search
+import sys
+import time
+
+import numpy as np
+
+import routing
+
+
+def randomDay(nodes, rng):
+    # Attractions scattered within roughly 10km of a property in Manhattan
+    return np.array([40.758, -73.985]) + rng.uniform(-0.09, 0.09, size=(nodes, 2))
+
+
+def timeSolver(solver, distances):
+    start = time.time()
+    tour = solver(distances)
+    return ((time.time()-start)*1000, routing.tourLength(tour, distances))
+
+
+def greedySolver(distances):
+    tour = routing.greedyEdgeTour(distances)
+    return routing.improveTour(tour, distances, routing.ROUTE_IMPROVEMENT_BUDGET)[0]
+
+
+if __name__ == '__main__':
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    budgetMs = float(sys.argv[2]) if len(sys.argv) > 2 else 50.0
+    rng = np.random.RandomState(0)
+
+    # Warm up NumPy before timing anything
+    routing.heldKarpTour(routing.distanceMatrix(randomDay(routing.HELD_KARP_MAX_NODES, rng)))
+
+    print("nodes  held-karp mean/max ms  greedy+local mean/max ms  greedy gap")
+    for nodes in range(4, routing.HELD_KARP_MAX_NODES+1):
+        exactTimes, greedyTimes, gaps = [], [], []
+        for day in range(days):
+            distances = routing.distanceMatrix(randomDay(nodes, rng))
+            exactMs, exactLength = timeSolver(routing.heldKarpTour, distances)
+            greedyMs, greedyLength = timeSolver(greedySolver, distances)
+            exactTimes.append(exactMs)
+            greedyTimes.append(greedyMs)
+            gaps.append(greedyLength/exactLength - 1)
+        print("{:5d}  {:9.2f} / {:7.2f}      {:9.2f} / {:7.2f}         {:6.2%}".format(
+            nodes, np.mean(exactTimes), np.max(exactTimes), np.mean(greedyTimes), np.max(greedyTimes), np.mean(gaps)))
+
+    worstDayMs = max(exactTimes)
+    print("Worst {}-node day: {:.2f} ms against a {:.0f} ms budget ({})".format(
+        routing.HELD_KARP_MAX_NODES, worstDayMs, budgetMs, "OK" if worstDayMs <= budgetMs else "OVER BUDGET"))
+
+    # Compare every registered solver, with lengths relative to the best tour found for each day
+    print("")
+    print("nodes  solver                mean ms   mean excess length")
+    for nodes in (13, 50, 200, 1000):
+        solverNames = [name for name in sorted(routing.ROUTE_SOLVERS) if name != 'held-karp' or nodes <= routing.HELD_KARP_MAX_NODES]
+        results = dict((name, []) for name in solverNames)
+        for day in range(max(1, days//10)):
+            coordinates = randomDay(nodes, rng)
+            solutions = [routing.solveRoute(coordinates, name) for name in solverNames]
+            best = min(solution.length for solution in solutions)
+            for solution in solutions:
+                results[solution.solver].append((solution.seconds*1000, solution.length/best - 1))
+        for name in solverNames:
+            print("{:5d}  {:20s}  {:8.2f}   {:6.2%}".format(
+                nodes, name, np.mean([ms for ms, excess in results[name]]), np.mean([excess for ms, excess in results[name]])))
@@ -0,0 +1,127 @@
+# Caches shared by the requests handled by one process, in memory or on disk
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    # Least-recently-used cache holding at most maxsize entries, each optionally
+    # expiring ttl seconds after it was stored. With sizeof, maxsize bounds the total
+    # sizeof of the values instead, such as their bytes. Safe to share between threads.
+
+    def __init__(self, maxsize, ttl=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                value, expires = self.entries.pop(key)
+                if expires is None or expires > time.time():
+                    self.entries[key] = (value, expires)
+                    self.hits += 1
+                    return value
+                self.total -= self.weight(value)
+            self.misses += 1
+            return default
+
+    def weight(self, value):
+        return self.sizeof(value) if self.sizeof is not None else 1
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.total -= self.weight(self.entries.pop(key)[0])
+            expires = time.time() + self.ttl if self.ttl is not None else None
+            self.entries[key] = (value, expires)
+            self.total += self.weight(value)
+            while self.total > self.maxsize:
+                self.total -= self.weight(self.entries.popitem(last=False)[1][0])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'total': self.total,
+                    'hit_rate': float(self.hits)/lookups if lookups else 0.0}
+
+
+class SQLiteCache(object):
+    # Least-recently-used cache of JSON values kept in an SQLite file, so entries outlive the
+    # process and are shared by every worker on the machine. Holds at most maxsize entries,
+    # each optionally expiring ttl seconds after it was stored. Safe to share between threads.
+
+    def __init__(self, path, maxsize, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # Connections are not carried over into forked processes
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, "
+                                    "expires REAL, used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+            self.pid = os.getpid()
+        return self.connection
+
+    def get(self, key, default=None):
+        with self.lock:
+            connection = self.connect()
+            now = time.time()
+            row = connection.execute("SELECT value, expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and (row[1] is None or row[1] > now):
+                with connection:
+                    connection.execute("UPDATE entries SET used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return json.loads(row[0])
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            connection = self.connect()
+            now = time.time()
+            expires = now + self.ttl if self.ttl is not None else None
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO entries (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                                   (key, json.dumps(value), expires, now))
+                connection.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+                connection.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used DESC "
+                                   "LIMIT -1 OFFSET ?)", (self.maxsize,))
+
+    def clear(self):
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("DELETE FROM entries")
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            size = self.connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'size': size,
+                    'hit_rate': float(self.hits)/lookups if lookups else 0.0}
@@ -0,0 +1,117 @@
+# Distance providers turning (lat, lng) coordinates into a km distance matrix for routing
+import os
+
+import numpy as np
+import requests
+
+from caching import LRUCache
+
+# 'haversine' keeps straight-line distances, 'routed' asks a routing server for road distances
+DISTANCE_PROVIDER = os.environ.get('DISTANCE_PROVIDER', 'haversine')
+
+# Base URL of an OSRM-compatible server, queried at /table/v1/driving/
+ROUTED_DISTANCE_URL = os.environ.get('ROUTED_DISTANCE_URL', 'http://localhost:5000')
+ROUTED_DISTANCE_TIMEOUT = float(os.environ.get('ROUTED_DISTANCE_TIMEOUT', '2'))
+
+# Sources and destinations per request, so each request stays within the server's
+# default limit of 100 coordinates per table
+ROUTED_MATRIX_BLOCK = int(os.environ.get('ROUTED_MATRIX_BLOCK', '50'))
+
+# Road distances between pairs of coordinates remembered across requests
+ROUTED_PAIR_CACHE_SIZE = int(os.environ.get('ROUTED_PAIR_CACHE_SIZE', '200000'))
+
+DISTANCE_PROVIDERS = {}
+
+
+def registerProvider(name):
+    # Providers take the coordinates and their straight-line matrix in km, and return the matrix to route on
+    def register(provider):
+        DISTANCE_PROVIDERS[name] = provider
+        return provider
+    return register
+
+
+@registerProvider('haversine')
+def haversineProvider(coordinates, straightLine):
+    return straightLine
+
+
+# Road distances in km keyed by the rounded (lat, lng) of both ends
+routedPairs = LRUCache(ROUTED_PAIR_CACHE_SIZE)
+
+
+def pairKey(origin, destination):
+    return (round(origin[0], 5), round(origin[1], 5), round(destination[0], 5), round(destination[1], 5))
+
+
+def fetchRoutedBlock(coordinates, sources, destinations):
+    # One table request for the sources x destinations block, returning km or None where the
+    # server found no route. Raises on timeouts and server errors.
+    nodes = list(sources) + [node for node in destinations if node not in sources]
+    position = dict((node, idx) for idx, node in enumerate(nodes))
+    url = "{}/table/v1/driving/{}".format(ROUTED_DISTANCE_URL.rstrip('/'),
+                                          ";".join("{:.6f},{:.6f}".format(coordinates[node][1], coordinates[node][0]) for node in nodes))
+    params = {'sources': ";".join(str(position[node]) for node in sources),
+              'destinations': ";".join(str(position[node]) for node in destinations),
+              'annotations': 'distance'}
+    data = requests.get(url, params=params, timeout=ROUTED_DISTANCE_TIMEOUT).json()
+    if data.get('code') != 'Ok':
+        raise ValueError("Routing server answered {}".format(data.get('code')))
+    return [[metres/1000.0 if metres is not None else None for metres in row] for row in data['distances']]
+
+
+@registerProvider('routed')
+def routedProvider(coordinates, straightLine):
+    # Road distances fetched in blocks of ROUTED_MATRIX_BLOCK sources and destinations, skipping
+    # blocks whose pairs are all cached. Pairs the server could not give keep their straight-line
+    # distance, and after a failed request the remaining blocks are not asked for. The matrix
+    # is averaged with its transpose because the route solvers expect the same distance in
+    # both directions.
+    coordinates = np.asarray(coordinates, dtype=float).tolist()
+    n = len(coordinates)
+    matrix = np.array(straightLine, dtype=float)
+    keys = [[pairKey(origin, destination) for destination in coordinates] for origin in coordinates]
+    missing = np.zeros((n, n), dtype=bool)
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                distance = routedPairs.get(keys[i][j])
+                if distance is None:
+                    missing[i][j] = True
+                else:
+                    matrix[i][j] = distance
+
+    requestCount = 0
+    available = True
+    blocks = range(0, n, ROUTED_MATRIX_BLOCK)
+    for rowStart in blocks:
+        for columnStart in blocks:
+            if not available or not missing[rowStart:rowStart+ROUTED_MATRIX_BLOCK, columnStart:columnStart+ROUTED_MATRIX_BLOCK].any():
+                continue
+            sources = list(range(rowStart, min(rowStart+ROUTED_MATRIX_BLOCK, n)))
+            destinations = list(range(columnStart, min(columnStart+ROUTED_MATRIX_BLOCK, n)))
+            requestCount += 1
+            try:
+                block = fetchRoutedBlock(coordinates, sources, destinations)
+            except (requests.exceptions.RequestException, ValueError, KeyError) as error:
+                print("Road distances unavailable, using straight lines: " + str(error))
+                available = False
+                continue
+            for i, row in zip(sources, block):
+                for j, distance in zip(destinations, row):
+                    if i == j or not missing[i][j]:
+                        continue
+                    # Pairs without a route are cached at their straight-line distance so
+                    # they are not asked for again, unlike pairs lost to a failed request
+                    if distance is None:
+                        distance = matrix[i][j]
+                    else:
+                        missing[i][j] = False
+                    matrix[i][j] = distance
+                    routedPairs.put(keys[i][j], distance)
+    print("Road distances for {} nodes: {} requests, {} straight-line fallbacks".format(n, requestCount, int(missing.sum())))
+    return (matrix + matrix.T)/2
+
+
+def providerMatrix(coordinates, straightLine, provider=None):
+    return DISTANCE_PROVIDERS[provider or DISTANCE_PROVIDER](coordinates, straightLine)
@@ -1,14 +1,12 @@
 # Basic imports
 import boto3
+from botocore.config import Config
 import datetime
 import openpyxl
 import time
 import random
 import base64
 import pickle
-import ast
-import copy
-from haversine import haversine
 import os
 
 # Data analysis/viz imports
@@ -24,7 +22,6 @@ import plotly.plotly as py
 
 # Web app imports
 import json
-import requests
 from flask import Flask
 from flask import send_from_directory
 from dash.dependencies import Input, Output, State
@@ -32,6 +29,19 @@ import dash_core_components as dcc
 import dash_html_components as html
 import dash
 import dash_auth
+
+# Route solving imports
+from routing import identifyTripTours, localProjection, newSessionId, orderRoute, routeCost, sessionDistanceMatrix, startRoutePool, storeSessionMatrix, vrpRoutes
+
+# POI table imports
+from pois import dedupe_stream, poi_table, poi_frame, table_coordinates, table_to_json, table_from_json
+from poi_store import POI_STORE_PATH, check_store, search_store
+
+# Outbound call guard imports
+from resilience import Upstream
+
+# Places lookup imports
+from places import PLACES_TIME_BUDGET, SEARCH_RADIUS, SEARCH_RADIUS_MODE, adaptive_search, fan_out, geocodes, nearbyTiles, normalise_query, places_get, placesFlights, placesLimiter, placesUpstream, tile_search
 """
 # External scripts imports
 import config
@@ -48,8 +58,23 @@ AWS_ACCESS_KEY_ID = os.environ['AWS_ACCESS_KEY_ID']
 AWS_REGION_NAME = os.environ['AWS_REGION_NAME']
 GOOGLE_MAPS_API_KEY = os.environ['GOOGLE_MAPS_API_KEY']
 
+# 'balanced' caps every day at its share of the attractions, 'kmeans' is plain K-means and
+# 'vrp' assigns and routes the days together
+CLUSTER_MODE = os.environ.get('CLUSTER_MODE', 'balanced')
+
+# Seconds to connect and to wait for each DynamoDB response before the attempt is retried
+DYNAMODB_TIMEOUT = float(os.environ.get('DYNAMODB_TIMEOUT', '3'))
+
 # Instantiate clients
-dynamodb = boto3.client('dynamodb', region_name=AWS_REGION_NAME, aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
+# The route pool is forked first, while this worker has no threads yet
+startRoutePool()
+# Retries are left to dynamodbUpstream, which also hedges slow calls and fails fast while DynamoDB is down
+dynamodb = boto3.client('dynamodb', region_name=AWS_REGION_NAME, aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                        config=Config(connect_timeout=DYNAMODB_TIMEOUT, read_timeout=DYNAMODB_TIMEOUT, retries={'max_attempts': 0}))
+dynamodbUpstream = Upstream('DynamoDB')
+# A wrong POI_STORE_PATH stops the app here rather than failing every search
+if POI_STORE_PATH:
+	print("POI store {} holds {} places".format(POI_STORE_PATH, check_store(POI_STORE_PATH)))
 
 
 # ===============================================================================================================================
@@ -89,10 +114,23 @@ def state_dropdown():
 
 
 def locate_property(state_value, city_value, property_value,):
-  # Find place location
+  # Find place location. Identical lookups made at the same time share one search.
   address = state_value + " " + city_value + " " + property_value
+  return placesFlights.do(('property', normalise_query(address)), find_property, address)
+
+
+def find_property(address):
+  cached = geocodes.get(normalise_query(address))
+  print("Geocode cache: {hits} hits, {misses} misses".format(**geocodes.stats()))
+  if cached is not None:
+    print("Selecting cached property: "+str(cached[0]))
+    return (cached[0], tuple(cached[1]))
   url = "https://maps.googleapis.com/maps/api/place/textsearch/json?query={}&key={}".format(address, GOOGLE_MAPS_API_KEY)
-  req = requests.get(url)
+  try:
+    req = places_get(url)
+  except Exception as error:
+    print("Property lookup failed: " + str(error))
+    return ("Error", (0,0))
   data = req.json()
   try:
     print(str(data))
@@ -102,71 +140,160 @@ def locate_property(state_value, city_value, property_value,):
     print ("Properties found!")
     print(list_loc)
     print("Selecting first property: "+str(property_name))
+    geocodes.put(normalise_query(address), [property_name, property_loc])
     return(property_name, property_loc)
   except:
     return ("Error", (0,0))
 
 
+def search_attractions(location, radius, attractions_value, deadline, totals=None):
+	# Generates [name, (lat, lng), type, place_id] records of the attractions within radius
+	# metres, following further result pages only while they can arrive before deadline.
+	# totals, if given, gets the number of results Places gave for each type before they were
+	# cut down to radius.
+	if POI_STORE_PATH:
+		# Served from the offline store instead of one live request per type. A store that
+		# cannot be read leaves step one without attractions rather than failing it.
+		try:
+			records = search_store(location, radius, attractions_value)
+		except Exception as error:
+			print("Search of the POI store failed: {}".format(error))
+			records = []
+		for record in records:
+			yield record
+		return
+
+	def search_type(attraction):
+		# A type that cannot be searched is left out rather than failing the whole step
+		try:
+			records, count = tile_search(location, radius, attraction, GOOGLE_MAPS_API_KEY, deadline=deadline)
+		except Exception as error:
+			print("Search for {} failed: {}".format(attraction, error))
+			return []
+		if totals is not None:
+			totals[attraction] = count
+		return records
+
+	# Types are searched concurrently and merged in the order they were selected
+	for records in fan_out(search_type, attractions_value):
+		for record in records:
+			yield record
+	print("Nearby search cache: {hits} hits, {misses} misses".format(**nearbyTiles.stats()))
+	print("Places upstream: {calls} calls, {retries} retries, {hedges} hedged, {short_circuited} failed fast, circuit {state}".format(**placesUpstream.stats()))
+
+
 def locate_nearby_attractions(property_loc, attractions_value, duration_value):
-	# Find nearby attractions
+	# Find nearby attractions. Identical searches made at the same time share one result.
 	if (len(attractions_value)==0 or property_loc==(0,0)):
-		return ([])
+		return (poi_table([]))
+	else:
+		key = ('nearby', tuple(property_loc), tuple(attractions_value), duration_value)
+		table = placesFlights.do(key, find_nearby_attractions, property_loc, attractions_value, duration_value)
+		print("Places lookups: {calls} calls, {shared} shared".format(**placesFlights.stats()))
+		print("Places rate limit: {acquired} requests, {throttled} throttled for {waited:.1f} s".format(**placesLimiter.stats()))
+		return (table)
+
+
+def find_nearby_attractions(property_loc, attractions_value, duration_value):
+	# Search for the attractions around the property and merge duplicates. Every search made
+	# for this step shares one time budget.
+	deadline = time.time() + PLACES_TIME_BUDGET
+
+	def search(location, radius, attractions, totals=None):
+		return search_attractions(location, radius, attractions, deadline, totals)
+
+	if SEARCH_RADIUS_MODE == 'adaptive':
+		POIs = adaptive_search(search, property_loc, attractions_value, duration_value)
 	else:
-		radius = 10000
-		POIs = []
-		for attraction in attractions_value:
-			url2 = "https://maps.googleapis.com/maps/api/place/nearbysearch/json?location={},{}&radius={}&type={}&key={}&rankby=prominence&language=en".format(property_loc[0], property_loc[1], radius, attraction, GOOGLE_MAPS_API_KEY)
-			print("Sending request to: "+url2)
-			req2 = requests.get(url2)
-			data2 = req2.json()
-			list_near_by = data2['results']
-			for near_by in list_near_by:
-				attraction_name = near_by['name']
-				attraction_loc = (near_by['geometry']['location']['lat'], near_by['geometry']['location']['lng'])
-				POIs.append([attraction_name.title(), attraction_loc, attraction])
-		print("Nearby attractions found!")
-		print(POIs)
-		return (POIs)
-
-
-def cluster_attractions(POIs, duration_value):
+		POIs = search(property_loc, SEARCH_RADIUS, attractions_value)
+	# The same venue is often listed under several types, so keep one entry per venue.
+	# Each type's results are merged as soon as that type's search is done.
+	table = dedupe_stream(POIs)
+	print("Nearby attractions found!")
+	print(table)
+	print("{} attractions left after merging duplicates".format(len(table)))
+	return (table)
+
+
+def balanced_kmeans(X, n_clusters, max_iter=10):
+	# K-means from a single k-means++ initialisation, with every point then reassigned so no
+	# cluster holds more than its share of points. Closest point-centre pairs are assigned first.
+	kmeans = KMeans(n_clusters=n_clusters, init='k-means++', n_init=1, random_state=0).fit(X)
+	centers = kmeans.cluster_centers_
+	labels = kmeans.labels_
+	capacity = int(np.ceil(float(len(X))/n_clusters))
+	for iteration in range(max_iter):
+		distances = ((X[:, None, :] - centers[None, :, :])**2).sum(axis=2)
+		new_labels = np.full(len(X), -1, dtype=int)
+		sizes = np.zeros(n_clusters, dtype=int)
+		assigned = 0
+		for pair in np.argsort(distances, axis=None, kind='stable').tolist():
+			point, cluster = divmod(pair, n_clusters)
+			if new_labels[point] == -1 and sizes[cluster] < capacity:
+				new_labels[point] = cluster
+				sizes[cluster] += 1
+				assigned += 1
+				if assigned == len(X):
+					break
+		if np.array_equal(new_labels, labels):
+			break
+		labels = new_labels
+		centers = np.array([X[labels == cluster].mean(axis=0) if sizes[cluster] > 0 else centers[cluster] for cluster in range(n_clusters)])
+	return labels
+
+
+def cluster_attractions(POIs, duration_value, points, distances=None):
+	# POIs is a POI table, points holds each POI's position in metres east and north of the
+	# accommodation and distances is the session matrix in km with the accommodation last.
+	# Days are returned as lists of POI ids.
 	length_POI = len(POIs)
 	if length_POI == 0:
 		return ([0])
 	elif length_POI <= duration_value:
-		location_array = []
-		for attraction in POIs:
-			location_array.append([attraction[1][0],attraction[1][1]])
-		X = np.array(location_array)
-		location_df = pd.DataFrame(X, columns=["lat","long"])
+		location_df = pd.DataFrame(np.asarray(points)/1000.0, columns=["east","north"])
 		fig = plt.figure(figsize=(8, 6))
-		location_df.plot(x="lat",y="long",kind="scatter", title='Coordinates of Locations')
+		location_df.plot(x="east",y="north",kind="scatter", title='Locations Around Accommodation (km)')
 		fig.savefig('/tmp/scatterplot.png', dpi=fig.dpi)
 
 		responseList = [length_POI]
-		for attraction in POIs:
-			responseList.append([attraction])
+		for poi_id in POIs['id'].tolist():
+			responseList.append([poi_id])
 		return (responseList)
 	else:
-		location_array = []
-		for attraction in POIs:
-			location_array.append([attraction[1][0],attraction[1][1]])
-		X = np.array(location_array)
-		kmeans = KMeans(n_clusters=duration_value, random_state=0).fit(X)
-		labels = kmeans.labels_
+		X = np.asarray(points)/1000.0
+		start = time.time()
+		capacity = int(np.ceil(float(length_POI)/duration_value))
+		if CLUSTER_MODE == 'vrp' and distances is not None:
+			# Days are assigned and routed together, with the accommodation as every day's depot
+			days = vrpRoutes(distances, np.vstack([X, [[0.0, 0.0]]]), duration_value, capacity)
+			labels = np.zeros(length_POI, dtype=int)
+			for day, route in enumerate(days):
+				labels[route] = day
+			twoPhase = balanced_kmeans(X, duration_value)
+			baseline = sum(routeCost(orderRoute(np.flatnonzero(twoPhase == day).tolist(), distances), distances) for day in range(duration_value))
+			total = sum(routeCost(route, distances) for route in days)
+			print("VRP plan covers {:.2f} km, {:.2f} km less than clustering then routing".format(total, baseline-total))
+		elif CLUSTER_MODE == 'balanced':
+			labels = balanced_kmeans(X, duration_value)
+		else:
+			labels = KMeans(n_clusters=duration_value, random_state=0).fit(X).labels_
+		print("Clustered {} attractions into {} days in {:.1f} ms".format(length_POI, duration_value, (time.time()-start)*1000))
 
 		fig = plt.figure(figsize=(8, 6))
-		plt.ylabel('Long')
-		plt.xlabel('Lat')
-		plt.title('Coordinates of Locations')
-		plt.scatter(X[:,0], X[:,1], c=kmeans.labels_.astype(float))
+		plt.ylabel('North of accommodation (km)')
+		plt.xlabel('East of accommodation (km)')
+		plt.title('Locations Around Accommodation')
+		plt.scatter(X[:,0], X[:,1], c=labels.astype(float))
 		fig.savefig('/tmp/scatterplot.png', dpi=fig.dpi)
 
 		responseList = [duration_value]
+		if CLUSTER_MODE == 'vrp' and distances is not None:
+			responseList.extend(days)
+			return (responseList)
 		for i in range(1, duration_value+1):
 			responseList.append([])
-		for idx, value in enumerate(POIs,0):
-			responseList[labels[idx]+1].append(value)
+		for idx in range(length_POI):
+			responseList[labels[idx]+1].append(idx)
 		return (responseList)
 
 
@@ -174,7 +301,7 @@ def get_display(idx, row, attractionTypeDic, outputNumber):
 
     attraction = row['Attraction']
     location = str(row['Location'])
-    attraction_type = attractionTypeDic[row['Type']]
+    attraction_type = ", ".join([attractionTypeDic[item] for item in row['Type']])
     # score = row['score']
 
     output = (html.Div(
@@ -185,7 +312,7 @@ def get_display(idx, row, attractionTypeDic, outputNumber):
 
             dcc.Checklist(
                 options=[
-                    {'label': '', 'value': 'selected'}
+                    {'label': '', 'value': str(row['Id'])}
                 ],
                 values=[],
                 labelStyle={'display': 'inline-block'},
@@ -258,113 +385,26 @@ def generate_excel_file(generated_ads_list):
     return download_url
 
 
-def identifyNodesEdges(locationsList, propertyNode):
-    if(len(locationsList)==0):
-        return ([])
-    else:
-        extendedLocationsList = copy.deepcopy(locationsList)
-        extendedLocationsList.append(propertyNode)
-
-        complete_dict = {}
-        for currentItem in extendedLocationsList:
-            for otherItem in extendedLocationsList:
-                if (currentItem != otherItem):
-                    if currentItem[0] not in complete_dict:
-                        complete_dict[currentItem[0]] = [[otherItem[0],haversine(currentItem[1], otherItem[1])]]
-                    else:
-                        complete_dict[currentItem[0]].append([otherItem[0],haversine(currentItem[1], otherItem[1])])
-
-        visitedNodes_dict = {}
-        for key in complete_dict:
-            visitedNodes_dict[key]=[key]
-
-        counter_dict = {}
-        for key in complete_dict:
-            counter_dict[key] = 2
-
-        edgeList = []
-
-        while True:
-            try:
-                minimum_dict = {}
-                for key in complete_dict:
-                    distances = []
-                    for value in complete_dict[key]:
-                        distances.append(value[1])
-                    indexOfSmallest = np.argmin(distances)
-                    minimum_dict[key]=complete_dict[key][indexOfSmallest]
-
-                shortestDistances=[]
-                for key,value in minimum_dict.items():
-                    shortestDistances.append(value[1])
-                shortestDistance = min(shortestDistances)
-
-                checkIfValidConnection = []
-                for key,value in minimum_dict.items():
-                    if value[1]==shortestDistance:
-                        checkIfValidConnection.append(value[0])
-
-                finalConnection=checkIfValidConnection
-                finalConnectionDistance=shortestDistance
-
-                if checkIfValidConnection[1] in visitedNodes_dict[checkIfValidConnection[0]]:
-                    # Connecting these 2 nodes forms a cyclic graph
-                    filteredList=copy.deepcopy([item for item in complete_dict[checkIfValidConnection[1]] if item[0]!=checkIfValidConnection[0]])
-                    complete_dict[checkIfValidConnection[1]]=filteredList
-                    filteredList=copy.deepcopy([item for item in complete_dict[checkIfValidConnection[0]] if item[0]!=checkIfValidConnection[1]])
-                    complete_dict[checkIfValidConnection[0]]=filteredList
-                else:
-                    connectedNodes = []
-                    for key,value in minimum_dict.items():
-                        if value[1]==shortestDistance:
-                            connectedNodes.append(value[0])
-
-                            newValue = copy.deepcopy(complete_dict[key])
-                            newValue.remove(value)
-                            complete_dict[key] = newValue
-                            counter_dict[key]=counter_dict[key]-1
-
-                    keysToPop = []
-                    for key in counter_dict:  
-                        if counter_dict[key]==0:
-                            complete_dict.pop(key, None)
-                            keysToPop.append(key)
-                            for completeKey, completeValue in complete_dict.items():
-                                filteredList=copy.deepcopy([item for item in completeValue if item[0]!=key])
-                                complete_dict[completeKey]=filteredList
-
-                    for key in keysToPop:
-                        counter_dict.pop(key, None)
-                    for node in visitedNodes_dict[connectedNodes[0]]:
-                        visitedNodes_dict[node]=visitedNodes_dict[node]+list(set(visitedNodes_dict[connectedNodes[1]])-set(visitedNodes_dict[node]))
-                    for node in visitedNodes_dict[connectedNodes[1]]:
-                        visitedNodes_dict[node]=visitedNodes_dict[node]+list(set(visitedNodes_dict[connectedNodes[0]])-set(visitedNodes_dict[node]))    
-
-                    edgeList.append([tuple(connectedNodes),shortestDistance])
-            except:
-                break
-        edgeList.append([tuple(finalConnection),finalConnectionDistance])
-        return(edgeList)
-
-
 def constructGraph(masterGraph):
     masterGraph=json.loads(masterGraph)
     G=nx.Graph()
 
-    for node in masterGraph[-2]:
+    # Nodes are keyed by id and labelled by name, so places sharing a name stay apart
+    nodeLabels = {}
+    for node in masterGraph[-2] + [masterGraph[-1]]:
         G.add_node(node[0])
-    G.add_node(masterGraph[-1][0])
+        nodeLabels[node[0]] = node[1]
 
-    for dayList in masterGraph[:-2]:
-        if len(dayList)!=0:
-            for edge in dayList:
-                G.add_edge(edge[0][0], edge[0][1], weight=round(edge[1],4))
+    for tour in masterGraph[:-2]:
+        if tour is not None:
+            for start, end, distance in zip(tour['stops'], tour['stops'][1:], tour['legs']):
+                G.add_edge(start, end, weight=round(distance,4))
 
     plt.figure(figsize=(15,10))
     plt.title('Shortest Route For Each Day')
     pos = nx.spring_layout(G)
     labels = nx.get_edge_attributes(G,'weight')
-    nx.draw_networkx(G,pos,node_size=10,node_color='g', font_size=11)
+    nx.draw_networkx(G,pos,labels=nodeLabels,node_size=10,node_color='g', font_size=11)
     nx.draw_networkx_edge_labels(G,pos,edge_labels=labels)
     plt.savefig("/tmp/graphnetwork.png", format="PNG")
 
@@ -548,13 +588,24 @@ def attraction_identifier(n_clicks, state_value, city_value, attractions_value,
       property_name,property_loc = locate_property(state_value, city_value, property_value)
       print(str(property_name))
       POIs = locate_nearby_attractions(property_loc, attractions_value, duration_value)
-      clusteredPOIsResponse = cluster_attractions(POIs, duration_value)
+      # Every location is projected once onto a flat frame around the accommodation, which
+      # clustering, plotting and route distances all share
+      points = localProjection(table_coordinates(POIs), property_loc)
+      # Distances for the whole session are computed once here, shared by clustering and
+      # sliced for every day in step two
+      distances = sessionDistanceMatrix(np.vstack([table_coordinates(POIs), [property_loc]]), np.vstack([points, [[0.0, 0.0]]])) if len(POIs) > 0 else None
+      clusteredPOIsResponse = cluster_attractions(POIs, duration_value, points, distances)
       time.sleep(2)
       print("===================================================================================")
       print("Clustered response: ")
-      clusteredPOIsResponse.append([property_name,property_loc])
+      clusteredPOIsResponse.append(table_to_json(POIs))
+      # The property entry also carries the id step two finds this session's distances under
+      sessionId = newSessionId()
+      clusteredPOIsResponse.append([property_name,property_loc,sessionId])
       print(clusteredPOIsResponse)
-      return (json.dumps(clusteredPOIsResponse))
+      response = json.dumps(clusteredPOIsResponse)
+      storeSessionMatrix(sessionId, distances)
+      return (response)
     else:
         return None
 
@@ -584,7 +635,11 @@ def updateCitiesList(value):
 	if value == '':
 		return None
 	else:
-		databaseResponse = dynamodb.get_item(TableName='United_States_Cities', Key={'state': {'S': value}},)
+		try:
+			databaseResponse = dynamodbUpstream.call(lambda: dynamodb.get_item(TableName='United_States_Cities', Key={'state': {'S': value}},))
+		except Exception as error:
+			print("Cities lookup failed: " + str(error))
+			return []
 		citiesList = databaseResponse['Item']['city']['SS']
 		
 		dropdown_list = []
@@ -611,70 +666,61 @@ def determineGraphPoints(n_clicks, details, api_base_response):
 					for adbox in temp:
 						childElements = adbox['props']['children']
 						if len(childElements[3]['props']['values'])==1:
-							location = ast.literal_eval(childElements[2]['props']['children'][0])
-							dayOneList.append([childElements[0]['props']['children'][0], location])
+							dayOneList.append(int(childElements[3]['props']['values'][0]))
 
 				if child['props']['id']=="segmentDayTwo":
 					temp = child['props']['children'][1]['props']['children']
 					for adbox in temp:
 						childElements = adbox['props']['children']
 						if len(childElements[3]['props']['values'])==1:
-							location = ast.literal_eval(childElements[2]['props']['children'][0])
-							dayTwoList.append([childElements[0]['props']['children'][0], location])
+							dayTwoList.append(int(childElements[3]['props']['values'][0]))
 
 				if child['props']['id']=="segmentDayThree":
 					temp = child['props']['children'][1]['props']['children']
 					for adbox in temp:
 						childElements = adbox['props']['children']
 						if len(childElements[3]['props']['values'])==1:
-							location = ast.literal_eval(childElements[2]['props']['children'][0])
-							dayThreeList.append([childElements[0]['props']['children'][0], location])
+							dayThreeList.append(int(childElements[3]['props']['values'][0]))
 
 				if child['props']['id']=="segmentDayFour":
 					temp = child['props']['children'][1]['props']['children']
 					for adbox in temp:
 						childElements = adbox['props']['children']
 						if len(childElements[3]['props']['values'])==1:
-							location = ast.literal_eval(childElements[2]['props']['children'][0])
-							dayFourList.append([childElements[0]['props']['children'][0], location])
+							dayFourList.append(int(childElements[3]['props']['values'][0]))
 
 				if child['props']['id']=="segmentDayFive":
 					temp = child['props']['children'][1]['props']['children']
 					for adbox in temp:
 						childElements = adbox['props']['children']
 						if len(childElements[3]['props']['values'])==1:
-							location = ast.literal_eval(childElements[2]['props']['children'][0])
-							dayFiveList.append([childElements[0]['props']['children'][0], location])
+							dayFiveList.append(int(childElements[3]['props']['values'][0]))
 
 				if child['props']['id']=="segmentDaySix":
 					temp = child['props']['children'][1]['props']['children']
 					for adbox in temp:
 						childElements = adbox['props']['children']
 						if len(childElements[3]['props']['values'])==1:
-							location = ast.literal_eval(childElements[2]['props']['children'][0])
-							daySixList.append([childElements[0]['props']['children'][0], location])
+							daySixList.append(int(childElements[3]['props']['values'][0]))
 
 				if child['props']['id']=="segmentDaySeven":
 					temp = child['props']['children'][1]['props']['children']
 					for adbox in temp:
 						childElements = adbox['props']['children']
 						if len(childElements[3]['props']['values'])==1:
-							location = ast.literal_eval(childElements[2]['props']['children'][0])
-							daySevenList.append([childElements[0]['props']['children'][0], location])
+							daySevenList.append(int(childElements[3]['props']['values'][0]))
 			except:
 				print("Not found")
 
 		response = json.loads(api_base_response)
 		propertyNode = response[-1]
 		print(str(propertyNode))
-		masterGraph = []
-		masterGraph.append(identifyNodesEdges(dayOneList,propertyNode))
-		masterGraph.append(identifyNodesEdges(dayTwoList,propertyNode))
-		masterGraph.append(identifyNodesEdges(dayThreeList,propertyNode))
-		masterGraph.append(identifyNodesEdges(dayFourList,propertyNode))
-		masterGraph.append(identifyNodesEdges(dayFiveList,propertyNode))
-		masterGraph.append(identifyNodesEdges(daySixList,propertyNode))
-		masterGraph.append(identifyNodesEdges(daySevenList,propertyNode))
+		# Nodes are addressed by POI id, with the property as the node after the last POI
+		table = table_from_json(response[-2])
+		names = table['name'].tolist() + [propertyNode[0]]
+		coordinates = np.vstack([table_coordinates(table), [propertyNode[1]]])
+		# Days are independent, so they are solved in parallel and returned in day order
+		masterGraph = identifyTripTours([dayOneList, dayTwoList, dayThreeList, dayFourList, dayFiveList, daySixList, daySevenList], names, coordinates, sessionId=propertyNode[2])
 		print("**********************MASTER GRAPH****************************")
 		print(str(masterGraph))
 		print("**************************************************************")
@@ -688,8 +734,8 @@ def determineGraphPoints(n_clicks, details, api_base_response):
 		onlyAttractionsList.extend(daySixList)
 		onlyAttractionsList.extend(daySevenList)
 
-		masterGraph.append(onlyAttractionsList)
-		masterGraph.append(propertyNode)
+		masterGraph.append([[node, names[node]] for node in onlyAttractionsList])
+		masterGraph.append([len(names)-1, propertyNode[0]])
 
 		return(json.dumps(masterGraph))
 	else:
@@ -717,48 +763,14 @@ def generateExcel(children):
 		return None
 	else:
 		graph_api_response = json.loads(children)
-		propertyNode = graph_api_response[-1][0]
 		totalDayList=graph_api_response[:-2]
 
+		# Each day's tour already lists its stops in visiting order from the property
 		formattedList = []
-		for idx, dayList in enumerate(totalDayList, 1):
-			if(len(dayList)!=0):
-				firstNodeFound = 0
-
-				while(firstNodeFound==0):
-					for edge in dayList:
-						if(edge[0][0]==propertyNode):
-							firstNodeFound = 1
-							currentNode = edge[0][1]
-							formattedList.append({'Day':idx, 'Start':propertyNode, 'End':edge[0][1], 'Distance':edge[1]})
-							dayList.remove(edge)
-							break
-
-				while(firstNodeFound==0):
-					for edge in dayList:
-						if(edge[0][1]==propertyNode):
-							firstNodeFound = 1
-							currentNode = edge[0][0]
-							formattedList.append({'Day':idx, 'Start':propertyNode, 'End':edge[0][0], 'Distance':edge[1]})
-							dayList.remove(edge)
-							break
-
-				while (len(dayList)!=0):
-					currentNodeFound = 0
-					for edge in dayList:
-						if(edge[0][0]==currentNode):
-							formattedList.append({'Day':idx, 'Start':currentNode, 'End':edge[0][1], 'Distance':edge[1]})
-							currentNode = edge[0][1]
-							dayList.remove(edge)
-							currentNodeFound = 1
-							break
-					if(currentNodeFound==0):
-						for edge in dayList:
-							if(edge[0][1]==currentNode):
-								formattedList.append({'Day':idx, 'Start':currentNode, 'End':edge[0][0], 'Distance':edge[1]})
-								currentNode = edge[0][0]
-								dayList.remove(edge)
-								break
+		for idx, tour in enumerate(totalDayList, 1):
+			if tour is not None:
+				for start, end, distance in zip(tour['names'], tour['names'][1:], tour['legs']):
+					formattedList.append({'Day':idx, 'Start':start, 'End':end, 'Distance':distance})
 
 		excel_download_url = generate_excel_file(formattedList)
 		return (excel_download_url)
@@ -775,8 +787,7 @@ def updateOutputOne(api_response):
 		api_response = json.loads(api_response)
 		if (api_response[0]>=1):
 			limitedResponse = api_response[1][:12]
-			cols = ['Attraction', 'Location', 'Type']
-			df = pd.DataFrame(limitedResponse, columns=cols)
+			df = poi_frame(table_from_json(api_response[-2]), limitedResponse)
 			return(display_output(df, 1))
 		else:
 			return None
@@ -800,8 +811,7 @@ def updateOutputTwo(api_response):
 		api_response = json.loads(api_response)
 		if (api_response[0]>=2):
 			limitedResponse = api_response[2][:12]
-			cols = ['Attraction', 'Location', 'Type']
-			df = pd.DataFrame(limitedResponse, columns=cols)
+			df = poi_frame(table_from_json(api_response[-2]), limitedResponse)
 			return(display_output(df, 2))
 		else:
 			return None
@@ -825,8 +835,7 @@ def updateOutputThree(api_response):
 		api_response = json.loads(api_response)
 		if (api_response[0]>=3):
 			limitedResponse = api_response[3][:12]
-			cols = ['Attraction', 'Location', 'Type']
-			df = pd.DataFrame(limitedResponse, columns=cols)
+			df = poi_frame(table_from_json(api_response[-2]), limitedResponse)
 			return(display_output(df, 3))
 		else:
 			return None
@@ -850,8 +859,7 @@ def updateOutputFour(api_response):
 		api_response = json.loads(api_response)
 		if (api_response[0]>=4):
 			limitedResponse = api_response[4][:12]
-			cols = ['Attraction', 'Location', 'Type']
-			df = pd.DataFrame(limitedResponse, columns=cols)
+			df = poi_frame(table_from_json(api_response[-2]), limitedResponse)
 			return(display_output(df, 4))
 		else:
 			return None
@@ -875,8 +883,7 @@ def updateOutputFive(api_response):
 		api_response = json.loads(api_response)
 		if (api_response[0]>=5):
 			limitedResponse = api_response[5][:12]
-			cols = ['Attraction', 'Location', 'Type']
-			df = pd.DataFrame(limitedResponse, columns=cols)
+			df = poi_frame(table_from_json(api_response[-2]), limitedResponse)
 			return(display_output(df, 5))
 		else:
 			return None
@@ -900,8 +907,7 @@ def updateOutputSix(api_response):
 		api_response = json.loads(api_response)
 		if (api_response[0]>=6):
 			limitedResponse = api_response[6][:12]
-			cols = ['Attraction', 'Location', 'Type']
-			df = pd.DataFrame(limitedResponse, columns=cols)
+			df = poi_frame(table_from_json(api_response[-2]), limitedResponse)
 			return(display_output(df, 6))
 		else:
 			return None
@@ -925,8 +931,7 @@ def updateOutputSeven(api_response):
 		api_response = json.loads(api_response)
 		if (api_response[0]>=7):
 			limitedResponse = api_response[7][:12]
-			cols = ['Attraction', 'Location', 'Type']
-			df = pd.DataFrame(limitedResponse, columns=cols)
+			df = poi_frame(table_from_json(api_response[-2]), limitedResponse)
 			return(display_output(df, 7))
 		else:
 			return None
@@ -0,0 +1,235 @@
+# Google Places lookups behind step one
+import math
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from caching import LRUCache, SQLiteCache
+from pois import ATTRACTION_TYPES, EARTH_RADIUS_M, distance_m, name_key
+from resilience import SingleFlight, TokenBucket, Upstream
+
+NEARBY_SEARCH_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json?location={},{}&radius={}&type={}&key={}&rankby=prominence&language=en"
+NEXT_PAGE_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json?pagetoken={}&key={}"
+
+# Results in one page of a nearby search. Places serves up to 3 pages of a search, but a
+# page token only becomes valid a couple of seconds after it is issued, so every further
+# page adds about NEXT_PAGE_DELAY seconds to step one. By default a second page is fetched.
+PLACES_PAGE_SIZE = 20
+PLACES_MAX_PAGES = int(os.environ.get('PLACES_MAX_PAGES', '2'))
+NEXT_PAGE_DELAY = 2.0
+
+# Seconds a step-one search may spend following further pages, enough for one more page
+# after a first page that answered within about 1.5 seconds. The first page of every type
+# is always fetched.
+PLACES_TIME_BUDGET = float(os.environ.get('PLACES_TIME_BUDGET', '3.5'))
+
+# 'fixed' searches SEARCH_RADIUS metres around the property, 'adaptive' sizes the radius to
+# find about POIS_PER_DAY attractions for every day of the stay
+SEARCH_RADIUS_MODE = os.environ.get('SEARCH_RADIUS_MODE', 'fixed')
+SEARCH_RADIUS = 10000
+MIN_SEARCH_RADIUS = 1000
+MAX_SEARCH_RADIUS = 50000
+POIS_PER_DAY = 12
+
+# Threads sending Places requests at once, each with its own kept-alive connection. By default
+# every attraction type is searched at the same time.
+PLACES_WORKERS = int(os.environ.get('PLACES_WORKERS', len(ATTRACTION_TYPES)))
+
+# Places requests per second sent by this process on average, and in a burst
+PLACES_RATE = float(os.environ.get('PLACES_RATE', '10'))
+PLACES_BURST = int(os.environ.get('PLACES_BURST', '20'))
+
+# Seconds to connect and to wait for each Places response before the attempt is retried
+PLACES_TIMEOUT = float(os.environ.get('PLACES_TIMEOUT', '5'))
+
+# Searches an adaptive lookup may send before settling for what it found
+ADAPTIVE_SEARCH_ROUNDS = int(os.environ.get('ADAPTIVE_SEARCH_ROUNDS', '3'))
+
+# Accommodation lookups kept on disk, keyed by their normalised query, for 30 days by default
+GEOCODE_CACHE_PATH = os.environ.get('GEOCODE_CACHE_PATH', '/tmp/geocode-cache.db')
+GEOCODE_CACHE_SIZE = int(os.environ.get('GEOCODE_CACHE_SIZE', '100000'))
+GEOCODE_CACHE_TTL = float(os.environ.get('GEOCODE_CACHE_TTL', str(30*24*3600)))
+geocodes = SQLiteCache(GEOCODE_CACHE_PATH, GEOCODE_CACHE_SIZE, GEOCODE_CACHE_TTL)
+
+# Nearby searches are shared by every request from the same tile of TILE_SIZE degrees. Each
+# tile's search reaches far enough to cover any search from within the tile.
+TILE_SIZE = float(os.environ.get('TILE_SIZE', '0.01'))
+NEARBY_CACHE_SIZE = int(os.environ.get('NEARBY_CACHE_SIZE', '4096'))
+NEARBY_CACHE_TTL = float(os.environ.get('NEARBY_CACHE_TTL', str(24*3600)))
+nearbyTiles = LRUCache(NEARBY_CACHE_SIZE, NEARBY_CACHE_TTL)
+
+# Attractions of each type per square metre last seen around each ~10km cell, which sizes
+# the first search there
+densities = LRUCache(4096)
+
+
+# Session and thread pool shared by every request handled by this process, created on first use
+placesSession = None
+placesPool = None
+placesLock = threading.Lock()
+
+
+def places_session():
+    global placesSession
+    with placesLock:
+        if placesSession is None:
+            placesSession = requests.Session()
+            placesSession.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=PLACES_WORKERS))
+        return placesSession
+
+
+# Identical lookups made at the same time share one upstream call, and every Places request,
+# including retries and hedged duplicates, waits for a token from the limiter
+placesFlights = SingleFlight()
+placesLimiter = TokenBucket(PLACES_RATE, PLACES_BURST)
+placesUpstream = Upstream('Places')
+
+
+# Places answers these statuses with HTTP 200. They are retried and count towards opening the
+# circuit like server errors do.
+PLACES_FAILED_STATUSES = ('OVER_QUERY_LIMIT', 'REQUEST_DENIED', 'UNKNOWN_ERROR')
+
+
+class PlacesStatusError(Exception):
+    pass
+
+
+def places_get(url):
+    # Raises once retries are exhausted or while the Places circuit is open
+    def attempt():
+        placesLimiter.acquire()
+        response = places_session().get(url, timeout=PLACES_TIMEOUT)
+        if response.status_code >= 500:
+            response.raise_for_status()
+        status = response.json().get('status')
+        if status in PLACES_FAILED_STATUSES:
+            raise PlacesStatusError("Places answered {}".format(status))
+        return response
+    return placesUpstream.call(attempt)
+
+
+def fan_out(function, items):
+    # Results of function for every item, computed on the thread pool and yielded in the
+    # order of items, each as soon as it and those before it are done
+    global placesPool
+    with placesLock:
+        if placesPool is None:
+            placesPool = ThreadPool(PLACES_WORKERS)
+    return placesPool.imap(function, items)
+
+
+def nearby_search(location, radius, attraction_type, api_key, max_pages=PLACES_MAX_PAGES, deadline=None):
+    # Generates [name, (lat, lng), type, place_id] records of a nearby search page by page,
+    # asking for the next page while pages remain and it can arrive before deadline
+    url = NEARBY_SEARCH_URL.format(location[0], location[1], radius, attraction_type, api_key)
+    for page in range(max_pages):
+        print("Sending request to: "+url)
+        data = places_get(url).json()
+        while data.get('status') == 'INVALID_REQUEST' and page > 0 and (deadline is None or time.time() < deadline):
+            # The page token is not valid yet
+            time.sleep(0.5)
+            data = places_get(url).json()
+        # Anything else that is not a result, such as a page token that never became valid,
+        # fails the search rather than passing for an empty one
+        if data.get('status') not in ('OK', 'ZERO_RESULTS'):
+            raise PlacesStatusError("Places answered {}".format(data.get('status')))
+        for near_by in data.get('results', []):
+            yield [near_by['name'].title(), (near_by['geometry']['location']['lat'], near_by['geometry']['location']['lng']),
+                   attraction_type, near_by['place_id']]
+        token = data.get('next_page_token')
+        if not token or (deadline is not None and time.time() + NEXT_PAGE_DELAY > deadline):
+            return
+        time.sleep(NEXT_PAGE_DELAY)
+        url = NEXT_PAGE_URL.format(token, api_key)
+
+
+def tile_search(location, radius, attraction_type, api_key, deadline=None):
+    # Records of a nearby search answered from the search of the tile holding location, which
+    # is sent on the first request from the tile, and filtered down to the true radius. Every
+    # page is fetched before the records are returned, so they can be cached for the tile,
+    # and a search that fails raises before anything is cached. Returns (records, total),
+    # where total is the number of results Places gave before filtering, which tells whether
+    # it had more than its pages could hold.
+    tile = (int(math.floor(location[0]/TILE_SIZE)), int(math.floor(location[1]/TILE_SIZE)))
+    centre = ((tile[0]+0.5)*TILE_SIZE, (tile[1]+0.5)*TILE_SIZE)
+    reach = int(math.ceil(radius + distance_m(centre, (tile[0]*TILE_SIZE, tile[1]*TILE_SIZE))))
+    if reach > MAX_SEARCH_RADIUS:
+        records = list(nearby_search(location, radius, attraction_type, api_key, deadline=deadline))
+        return (records, len(records))
+
+    key = (tile, attraction_type, radius)
+    records = nearbyTiles.get(key)
+    if records is None:
+        records = list(nearby_search(centre, reach, attraction_type, api_key, deadline=deadline))
+        nearbyTiles.put(key, records)
+    if not records:
+        return ([], 0)
+    return ([record for record, distance in zip(records, distances_from(location, records).tolist()) if distance <= radius],
+            len(records))
+
+
+def normalise_query(query):
+    # Case, punctuation and spacing do not change what a text search finds
+    return name_key(query)
+
+
+def density_key(location, attraction_type):
+    return (round(location[0], 1), round(location[1], 1), attraction_type)
+
+
+def radius_for(count, density):
+    # Radius of the circle expected to hold count attractions
+    radius = math.sqrt(count/(math.pi*density)) if density > 0 else MAX_SEARCH_RADIUS
+    return int(min(max(radius, MIN_SEARCH_RADIUS), MAX_SEARCH_RADIUS))
+
+
+def distances_from(location, records):
+    coordinates = np.radians(np.array([record[1] for record in records], dtype=float).reshape(-1, 2))
+    origin = np.radians(np.asarray(location, dtype=float))
+    d = (np.sin((coordinates[:, 0]-origin[0])*0.5)**2
+         + np.cos(origin[0])*np.cos(coordinates[:, 0])*np.sin((coordinates[:, 1]-origin[1])*0.5)**2)
+    return 2*EARTH_RADIUS_M*np.arcsin(np.sqrt(np.clip(d, 0.0, 1.0)))
+
+
+def adaptive_search(search, location, attraction_types, duration_value):
+    # Search with a radius sized from the density last seen near location, widen it while too
+    # few attractions turn up, then cut the results down to the nearest ones if there are far
+    # more than the days can show. search(location, radius, attraction_types, totals) generates
+    # records, and may set totals[attraction_type] to the number of results the upstream search
+    # gave for the type, where that is more than the records within radius.
+    target = POIS_PER_DAY*duration_value
+    known = [densities.get(density_key(location, attraction_type)) for attraction_type in attraction_types]
+    radius = radius_for(target, sum(known)) if None not in known else SEARCH_RADIUS
+    totals = {}
+    records = list(search(location, radius, attraction_types, totals))
+    rounds = 1
+    while rounds < ADAPTIVE_SEARCH_ROUNDS and radius < MAX_SEARCH_RADIUS:
+        found = len(set(record[3] for record in records))
+        # Types that filled every page already have more attractions than a wider search would add
+        unfilled = [attraction_type for attraction_type in attraction_types
+                    if totals.get(attraction_type, sum(1 for record in records if record[2] == attraction_type))
+                    < PLACES_PAGE_SIZE*PLACES_MAX_PAGES]
+        if found >= target or not unfilled:
+            break
+        radius = max(radius_for(target, found/(math.pi*radius**2)), min(2*radius, MAX_SEARCH_RADIUS))
+        records = [record for record in records if record[2] not in unfilled] + list(search(location, radius, unfilled, totals))
+        rounds += 1
+
+    # Shrinking needs no new search, the results beyond the nearest target attractions are dropped
+    places = {}
+    for record, distance in zip(records, distances_from(location, records).tolist()):
+        places[record[3]] = distance
+    if len(places) > target:
+        radius = max(sorted(places.values())[target-1], 1.0)
+        records = [record for record in records if places[record[3]] <= radius]
+        places = dict((place_id, distance) for place_id, distance in places.items() if distance <= radius)
+    for attraction_type in attraction_types:
+        found = len(set(record[3] for record in records if record[2] == attraction_type))
+        densities.put(density_key(location, attraction_type), found/(math.pi*radius**2))
+    print("Adaptive search found {} attractions within {:.0f} m in {} rounds".format(len(places), radius, rounds))
+    return records
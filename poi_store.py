@@ -0,0 +1,118 @@
+# Offline store of exported Places results, so step one can find attractions without the Places API
+# Usage: python poi_store.py store.db export.json [export.json ...]
+# Each export is a nearbysearch response or a list of its results.
+import json
+import os
+import sqlite3
+import sys
+from contextlib import closing
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+import numpy as np
+
+from pois import EARTH_RADIUS_M, TYPE_CODES, types_mask
+
+# SQLite file answering nearby searches in place of the Places API, unset to search live
+POI_STORE_PATH = os.environ.get('POI_STORE_PATH', '')
+
+# Results per attraction type, as many as one page of a live nearby search
+STORE_RESULTS_PER_TYPE = 20
+
+SCHEMA = ["CREATE TABLE IF NOT EXISTS pois (id INTEGER PRIMARY KEY, place_id TEXT UNIQUE, name TEXT, "
+          "lat REAL, lng REAL, types INTEGER, prominence INTEGER)",
+          "CREATE VIRTUAL TABLE IF NOT EXISTS poi_index USING rtree(id, min_lat, max_lat, min_lng, max_lng)"]
+
+
+def open_store(path):
+    connection = sqlite3.connect(path)
+    for statement in SCHEMA:
+        connection.execute(statement)
+    return connection
+
+
+def load_places(connection, results):
+    # Add Places results to the store in one transaction. A place already stored keeps its
+    # row and gains any new attraction types. Returns the number of new places.
+    places = {}
+    for result in results:
+        attraction_types = [attraction_type for attraction_type in result.get('types', []) if attraction_type in TYPE_CODES]
+        if not attraction_types:
+            continue
+        location = result['geometry']['location']
+        place = places.setdefault(result['place_id'], [result['name'].title(), location['lat'], location['lng'], 0,
+                                                       result.get('user_ratings_total', 0)])
+        place[3] |= types_mask(attraction_types)
+
+    with connection:
+        existing = {}
+        place_ids = list(places)
+        for start in range(0, len(place_ids), 500):
+            chunk = place_ids[start:start+500]
+            existing.update(connection.execute("SELECT place_id, types FROM pois WHERE place_id IN ({})".format(
+                ", ".join("?"*len(chunk))), chunk).fetchall())
+        connection.executemany("UPDATE pois SET types = ? WHERE place_id = ?",
+                               [(types | places[place_id][3], place_id) for place_id, types in existing.items()])
+        new = [(place_id,) + tuple(place) for place_id, place in places.items() if place_id not in existing]
+        connection.executemany("INSERT INTO pois (place_id, name, lat, lng, types, prominence) VALUES (?, ?, ?, ?, ?, ?)", new)
+        connection.execute("INSERT INTO poi_index SELECT id, lat, lat, lng, lng FROM pois WHERE id NOT IN (SELECT id FROM poi_index)")
+    return len(new)
+
+
+def query_store(connection, location, radius, attraction_types, limit=STORE_RESULTS_PER_TYPE):
+    # [name, (lat, lng), type, place_id] records within radius metres of location, up to limit
+    # of the most prominent places for each attraction type, in the order a live search returns them
+    lat_margin = np.degrees(float(radius)/EARTH_RADIUS_M)
+    lng_margin = lat_margin/max(np.cos(np.radians(location[0])), 1e-6)
+    rows = connection.execute(
+        "SELECT pois.name, pois.lat, pois.lng, pois.types, pois.place_id, pois.prominence FROM poi_index "
+        "JOIN pois ON pois.id = poi_index.id WHERE min_lat <= ? AND max_lat >= ? AND min_lng <= ? AND max_lng >= ? "
+        "ORDER BY pois.prominence DESC, pois.id",
+        (location[0]+lat_margin, location[0]-lat_margin, location[1]+lng_margin, location[1]-lng_margin)).fetchall()
+    if not rows:
+        return []
+
+    # The box is cut down to the true radius
+    coordinates = np.radians(np.array([[row[1], row[2]] for row in rows]))
+    origin = np.radians(np.asarray(location, dtype=float))
+    d = (np.sin((coordinates[:, 0]-origin[0])*0.5)**2
+         + np.cos(origin[0])*np.cos(coordinates[:, 0])*np.sin((coordinates[:, 1]-origin[1])*0.5)**2)
+    inside = 2*EARTH_RADIUS_M*np.arcsin(np.sqrt(np.clip(d, 0.0, 1.0))) <= radius
+
+    records = []
+    for attraction_type in attraction_types:
+        bit = 1 << TYPE_CODES[attraction_type]
+        matches = [row for row, within in zip(rows, inside.tolist()) if within and row[3] & bit]
+        for name, lat, lng, types, place_id, prominence in matches[:limit]:
+            records.append([name, (lat, lng), attraction_type, place_id])
+    return records
+
+
+def connect_store(path):
+    # Opened read-only, so a wrong path fails rather than creating an empty store
+    return sqlite3.connect('file:{}?mode=ro'.format(pathname2url(os.path.abspath(path))), uri=True)
+
+
+def check_store(path):
+    # Number of places in the store, raising sqlite3.Error if it cannot be read
+    with closing(connect_store(path)) as connection:
+        return connection.execute("SELECT COUNT(*) FROM pois").fetchone()[0]
+
+
+def search_store(location, radius, attraction_types, path=None):
+    with closing(connect_store(path or POI_STORE_PATH)) as connection:
+        return query_store(connection, location, radius, attraction_types)
+
+
+if __name__ == '__main__':
+    with closing(open_store(sys.argv[1])) as connection:
+        for export in sys.argv[2:]:
+            with open(export) as export_file:
+                results = json.load(export_file)
+            if isinstance(results, dict):
+                results = results['results']
+            print("{}: {} new places".format(export, load_places(connection, results)))
+        print("{} places stored".format(connection.execute("SELECT COUNT(*) FROM pois").fetchone()[0]))
@@ -0,0 +1,142 @@
+# Compact table of the attractions (POIs) found around a property
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+# Attraction types in the order of their interned codes
+ATTRACTION_TYPES = ['amusement_park', 'aquarium', 'art_gallery', 'museum', 'casino', 'church', 'city_hall',
+                    'hindu_temple', 'mosque', 'library', 'park', 'shopping_mall', 'stadium', 'zoo']
+TYPE_CODES = dict((attraction_type, code) for code, attraction_type in enumerate(ATTRACTION_TYPES))
+
+# POIs with the same name closer than this many metres are treated as the same venue
+DEDUP_RADIUS = float(os.environ.get('DEDUP_RADIUS', '25'))
+EARTH_RADIUS_M = 6371008.8
+
+
+def poi_dtype(name_length, place_id_length):
+    # One record per POI. Its id is also its row in the table and its node id when routing.
+    # types is a bitmask of every attraction type the POI was found under.
+    return np.dtype([('id', np.int32), ('name', 'U{}'.format(max(name_length, 1))), ('lat', np.float32),
+                     ('lng', np.float32), ('types', np.uint16), ('place_id', 'S{}'.format(max(place_id_length, 1)))])
+
+
+def types_mask(attraction_types):
+    mask = 0
+    for attraction_type in attraction_types:
+        mask |= 1 << TYPE_CODES[attraction_type]
+    return mask
+
+
+def mask_types(mask):
+    return [attraction_type for code, attraction_type in enumerate(ATTRACTION_TYPES) if int(mask) & (1 << code)]
+
+
+def poi_table(records):
+    # Build the table from (name, (lat, lng), types, place_id) records, where types is
+    # either one attraction type or a list of them
+    records = list(records)
+    dtype = poi_dtype(max([len(record[0]) for record in records] or [1]), max([len(record[3]) for record in records] or [1]))
+    table = np.zeros(len(records), dtype=dtype)
+    for idx, (name, location, attraction_types, place_id) in enumerate(records):
+        if not isinstance(attraction_types, list):
+            attraction_types = [attraction_types]
+        table[idx] = (idx, name, location[0], location[1], types_mask(attraction_types), place_id.encode('ascii'))
+    return table
+
+
+def distance_m(first, second):
+    lat1, lng1, lat2, lng2 = map(math.radians, (first[0], first[1], second[0], second[1]))
+    d = math.sin((lat2-lat1)*0.5)**2 + math.cos(lat1)*math.cos(lat2)*math.sin((lng2-lng1)*0.5)**2
+    return 2*EARTH_RADIUS_M*math.asin(math.sqrt(min(max(d, 0.0), 1.0)))
+
+
+def name_key(name):
+    # Case, punctuation and spacing do not make two names different
+    return " ".join("".join(character if character.isalnum() else " " for character in name.lower()).split())
+
+
+def dedupe_stream(records, radius=DEDUP_RADIUS):
+    # Build the POI table from (name, (lat, lng), types, place_id) records, merging each one as
+    # it arrives into an earlier POI sharing its place_id, or else into the nearest earlier POI
+    # with the same name within radius metres. Each record is only compared with the first POI
+    # of every group, so a row of different venues a few metres apart is never chained into
+    # one. Merged POIs keep the first one's details and every one's types. records may be a
+    # generator, so the merging overlaps with fetching them.
+    merged = []
+    by_place_id = {}
+
+    # Nearby POIs are found through a grid of cells at least radius wide, which holds for
+    # anywhere within 5 degrees of latitude of the first POI
+    cells = {}
+    cell_size = None
+    for name, location, attraction_types, place_id in records:
+        if not isinstance(attraction_types, list):
+            attraction_types = [attraction_types]
+        mask = types_mask(attraction_types)
+        group = by_place_id.get(place_id)
+
+        if cell_size is None:
+            lat_size = math.degrees(max(radius, 1.0)/EARTH_RADIUS_M)
+            cell_size = (lat_size, lat_size/math.cos(math.radians(min(abs(location[0])+5, 89))))
+        cell = (int(math.floor(location[0]/cell_size[0])), int(math.floor(location[1]/cell_size[1])))
+        if group is None:
+            key = name_key(name)
+            nearest = radius
+            for lat_step in (-1, 0, 1):
+                for lng_step in (-1, 0, 1):
+                    for other in cells.get((cell[0]+lat_step, cell[1]+lng_step), []):
+                        if merged[other][4] != key:
+                            continue
+                        distance = distance_m(location, merged[other][1])
+                        if distance <= nearest:
+                            group, nearest = other, distance
+
+        if group is None:
+            group = len(merged)
+            merged.append([name, location, mask, place_id, name_key(name)])
+            cells.setdefault(cell, []).append(group)
+        else:
+            merged[group][2] |= mask
+        by_place_id.setdefault(place_id, group)
+
+    return poi_table((name, location, mask_types(types), place_id) for name, location, types, place_id, key in merged)
+
+
+def dedupe_pois(table, radius=DEDUP_RADIUS):
+    # Merge POIs sharing a place_id, or named alike and lying within radius metres of each
+    # other, into the first of them, which keeps every merged POI's types. Ids are renumbered.
+    if len(table) < 2:
+        return table
+    return dedupe_stream(zip(table['name'].tolist(), table_coordinates(table).tolist(),
+                             [mask_types(types) for types in table['types'].tolist()],
+                             [place_id.decode('ascii') for place_id in table['place_id'].tolist()]), radius)
+
+
+def table_coordinates(table):
+    return np.column_stack((table['lat'], table['lng'])).astype(float)
+
+
+def table_to_json(table):
+    # Column-wise form for the hidden divs, with each field listed once rather than per POI.
+    # Coordinates are rounded back to the 6 decimals Places gives. Place ids are left out,
+    # as they only matter while merging duplicates in step one.
+    return {'name': table['name'].tolist(),
+            'lat': np.round(table['lat'].astype(float), 6).tolist(),
+            'lng': np.round(table['lng'].astype(float), 6).tolist(),
+            'types': table['types'].tolist()}
+
+
+def table_from_json(columns):
+    return poi_table(zip(columns['name'], zip(columns['lat'], columns['lng']),
+                         [mask_types(mask) for mask in columns['types']], [''] * len(columns['name'])))
+
+
+def poi_frame(table, ids):
+    # Rows for the day's attraction boxes
+    rows = []
+    for poi in table[ids]:
+        location = (round(float(poi['lat']), 6), round(float(poi['lng']), 6))
+        rows.append([int(poi['id']), poi['name'], location, mask_types(poi['types'])])
+    return pd.DataFrame(rows, columns=['Id', 'Attraction', 'Location', 'Type'])
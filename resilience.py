@@ -0,0 +1,197 @@
+# Guards around calls to external services, shared by the threads of one process
+import random
+import threading
+import time
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class SingleFlight(object):
+    # Runs one call per key at a time. Callers arriving while a call for their key is in
+    # flight wait for it and share its result, or its exception.
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        with self.lock:
+            self.calls += 1
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = {'done': threading.Event(), 'result': None, 'error': None}
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if leader:
+            try:
+                flight['result'] = function(*args)
+            except Exception as error:
+                flight['error'] = error
+            finally:
+                with self.lock:
+                    del self.flights[key]
+                flight['done'].set()
+        else:
+            flight['done'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result']
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self.flights)}
+
+
+class TokenBucket(object):
+    # Lets through rate calls per second on average and bursts of up to burst calls,
+    # making callers wait for their turn beyond that
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.acquired = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now-self.updated)*self.rate)
+            self.updated = now
+            # Tokens may go negative, which queues callers in the order they arrived
+            self.tokens -= 1
+            wait = -self.tokens/self.rate if self.tokens < 0 else 0.0
+            self.acquired += 1
+            if wait > 0:
+                self.throttled += 1
+                self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        with self.lock:
+            return {'acquired': self.acquired, 'throttled': self.throttled, 'waited': self.waited}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class Upstream(object):
+    # Calls to one external service. A call is sent again with jittered exponential backoff
+    # when it fails, and a duplicate is sent if it is still running after the p95 latency of
+    # recent calls, using whichever answers first. After failures consecutive failed attempts
+    # the circuit opens and calls fail at once for reset seconds, after which one call is let
+    # through to test the service. Functions called are expected to enforce their own timeout.
+
+    def __init__(self, name, retries=2, backoff=0.2, failures=5, reset=30.0, hedge_quantile=0.95, window=200):
+        self.name = name
+        self.retries = retries
+        self.backoff = backoff
+        self.failures = failures
+        self.reset = reset
+        self.hedge_quantile = hedge_quantile
+        self.latencies = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.opened = None
+        self.trial = False
+        self.counts = {'calls': 0, 'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'failures': 0, 'short_circuited': 0}
+        self.lock = threading.Lock()
+
+    def hedge_delay(self):
+        # Only hedge once there are enough latencies for a stable quantile
+        with self.lock:
+            if len(self.latencies) < 20:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[int(self.hedge_quantile*(len(latencies)-1))]
+
+    def admit(self):
+        with self.lock:
+            self.counts['calls'] += 1
+            if self.opened is None:
+                return
+            if time.time() - self.opened >= self.reset and not self.trial:
+                self.trial = True
+                return
+            self.counts['short_circuited'] += 1
+        raise CircuitOpenError("{} is unavailable, calls are failing fast".format(self.name))
+
+    def record(self, latency, error):
+        with self.lock:
+            if error is None:
+                self.latencies.append(latency)
+                self.consecutive_failures = 0
+                self.opened = None
+            else:
+                self.counts['failures'] += 1
+                self.consecutive_failures += 1
+                if self.trial or self.consecutive_failures >= self.failures:
+                    if self.opened is None or self.trial:
+                        print("Circuit for {} opened after {} failures".format(self.name, self.consecutive_failures))
+                    self.opened = time.time()
+            self.trial = False
+
+    def attempt(self, index, function, results):
+        start = time.time()
+        try:
+            result, error = function(), None
+        except Exception as exception:
+            result, error = None, exception
+        self.record(time.time()-start, error)
+        results.put((index, result, error))
+
+    def hedged(self, function):
+        # One attempt, plus a duplicate if the first is slower than usual. Returns
+        # (result, error) of the first success, or of the last failure.
+        results = queue.Queue()
+        threading.Thread(target=self.attempt, args=(0, function, results)).start()
+        delay = self.hedge_delay()
+        try:
+            index, result, error = results.get(timeout=delay) if delay is not None else results.get()
+            return (result, error)
+        except queue.Empty:
+            pass
+        with self.lock:
+            self.counts['hedges'] += 1
+        threading.Thread(target=self.attempt, args=(1, function, results)).start()
+        for answer in range(2):
+            index, result, error = results.get()
+            if error is None:
+                if index == 1:
+                    with self.lock:
+                        self.counts['hedge_wins'] += 1
+                return (result, error)
+        return (result, error)
+
+    def call(self, function):
+        for attempt in range(self.retries+1):
+            self.admit()
+            result, error = self.hedged(function)
+            if error is None:
+                return result
+            if attempt < self.retries:
+                with self.lock:
+                    self.counts['retries'] += 1
+                time.sleep(random.uniform(0, self.backoff*2**attempt))
+        raise error
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['state'] = 'closed' if self.opened is None else 'open'
+        stats['p95'] = self.hedge_delay()
+        return stats
@@ -0,0 +1,751 @@
+# Route solving for each day of the trip
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import uuid
+from collections import deque, namedtuple
+
+import numpy as np
+import networkx as nx
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.spatial import cKDTree
+
+from caching import LRUCache
+from distances import providerMatrix
+
+# Route solver used when a request does not name one, see ROUTE_SOLVERS
+ROUTE_SOLVER = os.environ.get('ROUTE_SOLVER', 'auto')
+
+# Seconds of 2-opt / Or-opt improvement spent on each day's greedy tour, 0 disables it
+ROUTE_IMPROVEMENT_BUDGET = float(os.environ.get('ROUTE_IMPROVEMENT_BUDGET', '0.05'))
+ROUTE_NEIGHBOURS = 8
+
+# Days with at most this many nodes (12 attractions plus the property) are solved exactly
+HELD_KARP_MAX_NODES = 13
+
+# Days with at least this many nodes only consider links to each node's nearest neighbours
+CANDIDATE_GREEDY_MIN_NODES = int(os.environ.get('CANDIDATE_GREEDY_MIN_NODES', '2000'))
+CANDIDATE_NEIGHBOURS = 10
+CANDIDATE_FULL_SCAN_ENDS = 500
+
+# Processes solving the days of a trip in parallel, 1 solves them in the calling process
+ROUTE_WORKERS = int(os.environ.get('ROUTE_WORKERS', multiprocessing.cpu_count()))
+
+# Number of solved days remembered, so re-selecting the same stops skips solving
+ROUTE_CACHE_SIZE = int(os.environ.get('ROUTE_CACHE_SIZE', '1024'))
+
+# Bytes of session distance matrices kept, 64MB by default, and for how many seconds
+SESSION_MATRIX_CACHE_BYTES = int(os.environ.get('SESSION_MATRIX_CACHE_BYTES', str(64*1024*1024)))
+SESSION_MATRIX_TTL = 3600
+
+# Seconds spent improving the joint assignment of attractions to days in VRP mode
+VRP_BUDGET = float(os.environ.get('VRP_BUDGET', '0.2'))
+
+# Same mean earth radius as the haversine package
+EARTH_RADIUS_KM = 6371.0088
+
+
+def pairDistances(origins, destinations):
+    # Great-circle distances in km between matching rows of two (lat, lng) arrays
+    origins = np.radians(np.asarray(origins, dtype=float))
+    destinations = np.radians(np.asarray(destinations, dtype=float))
+    dLat = destinations[..., 0] - origins[..., 0]
+    dLng = destinations[..., 1] - origins[..., 1]
+    d = np.sin(dLat*0.5)**2 + np.cos(origins[..., 0])*np.cos(destinations[..., 0])*np.sin(dLng*0.5)**2
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.sqrt(np.clip(d, 0.0, 1.0)))
+
+
+def distanceMatrix(coordinates):
+    # Great-circle distances in km between every pair of (lat, lng) coordinates
+    points = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+    matrix = pairDistances(points[:, None, :], points[None, :, :])
+    # Keep the matrix exactly symmetric with a zero diagonal
+    matrix = np.triu(matrix, 1)
+    return matrix + matrix.T
+
+
+def localProjection(coordinates, origin):
+    # Equirectangular projection of (lat, lng) coordinates to metres east and north of origin.
+    # Within about 10 km of the property, distances on it are within about 0.2% of great-circle ones.
+    radians = np.radians(np.asarray(coordinates, dtype=float).reshape(-1, 2))
+    originLat, originLng = np.radians(np.asarray(origin, dtype=float))
+    east = (radians[:, 1] - originLng)*np.cos(originLat)*EARTH_RADIUS_KM*1000
+    north = (radians[:, 0] - originLat)*EARTH_RADIUS_KM*1000
+    return np.column_stack((east, north))
+
+
+def planarDistanceMatrix(points):
+    # Straight-line distances in km between every pair of projected points in metres
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    offsets = points[:, None, :] - points[None, :, :]
+    return np.sqrt((offsets**2).sum(axis=2))/1000
+
+
+def unitVectors(coordinates):
+    # Points on the unit sphere, where straight-line (chord) distance ranks like great-circle distance
+    radians = np.radians(np.asarray(coordinates, dtype=float).reshape(-1, 2))
+    cosLat = np.cos(radians[:, 0])
+    return np.column_stack((cosLat*np.cos(radians[:, 1]), cosLat*np.sin(radians[:, 1]), np.sin(radians[:, 0])))
+
+
+def findRoot(parent, node):
+    # Union-find lookup with path halving
+    while parent[node] != node:
+        parent[node] = parent[parent[node]]
+        node = parent[node]
+    return node
+
+
+def greedyLinks(candidateEdges, parent, adjacency, linked):
+    # Greedy heuristic: accept a link unless it gives a node a third link or closes a cycle early.
+    # candidateEdges must be sorted from shortest to longest. Returns the new number of links.
+    target = len(adjacency)-1
+    for i, j in candidateEdges:
+        if linked == target:
+            break
+        if len(adjacency[i]) == 2 or len(adjacency[j]) == 2:
+            continue
+        rootI = findRoot(parent, i)
+        rootJ = findRoot(parent, j)
+        if rootI == rootJ:
+            continue
+        parent[rootI] = rootJ
+        adjacency[i].append(j)
+        adjacency[j].append(i)
+        linked += 1
+    return linked
+
+
+def closeTour(adjacency):
+    # Join the two loose ends of a Hamiltonian path and walk the resulting cycle
+    i, j = [node for node in range(len(adjacency)) if len(adjacency[node]) < 2]
+    adjacency[i].append(j)
+    adjacency[j].append(i)
+
+    tour = [0]
+    previous, current = 0, adjacency[0][0]
+    while current != 0:
+        tour.append(current)
+        previous, current = current, adjacency[current][0] if adjacency[current][0] != previous else adjacency[current][1]
+    return tour
+
+
+def greedyEdgeTour(distances):
+    n = len(distances)
+    if n < 3:
+        return list(range(n))
+
+    # Every candidate link, sorted once from shortest to longest
+    rows, cols = np.triu_indices(n, 1)
+    order = np.argsort(distances[rows, cols], kind='stable')
+    candidateEdges = zip(rows[order].tolist(), cols[order].tolist())
+
+    adjacency = [[] for node in range(n)]
+    greedyLinks(candidateEdges, list(range(n)), adjacency, 0)
+    return closeTour(adjacency)
+
+
+def nearestCandidateEdges(points, nodes, k):
+    # Links from each of nodes to its k nearest other nodes, deduplicated and sorted by length
+    k = min(k, len(nodes)-1)
+    chords, nearest = cKDTree(points[nodes]).query(points[nodes], k+1)
+    rows = np.repeat(np.arange(len(nodes)), k+1)
+    cols = nearest.ravel()
+    lengths = chords.ravel()
+    keep = rows != cols
+    low = np.minimum(rows, cols)[keep]
+    high = np.maximum(rows, cols)[keep]
+    unique = np.unique(low*len(nodes) + high, return_index=True)[1]
+    low, high, lengths = low[unique], high[unique], lengths[keep][unique]
+    order = np.lexsort((high, low, lengths))
+    nodes = np.asarray(nodes)
+    return zip(nodes[low[order]].tolist(), nodes[high[order]].tolist())
+
+
+def candidateGreedyTour(coordinates, k=CANDIDATE_NEIGHBOURS):
+    # Greedy heuristic over each node's k nearest neighbours only, so memory stays O(n*k).
+    # Path fragments left over are joined by repeating the search over their loose ends,
+    # with a full scan once few enough ends remain.
+    points = unitVectors(coordinates)
+    n = len(points)
+    if n < 3:
+        return list(range(n))
+
+    parent = list(range(n))
+    adjacency = [[] for node in range(n)]
+    linked = greedyLinks(nearestCandidateEdges(points, list(range(n)), k), parent, adjacency, 0)
+    while linked < n-1:
+        looseEnds = [node for node in range(n) if len(adjacency[node]) < 2]
+        if len(looseEnds) <= CANDIDATE_FULL_SCAN_ENDS:
+            endDistances = distanceMatrix(np.asarray(coordinates, dtype=float).reshape(-1, 2)[looseEnds])
+            rows, cols = np.triu_indices(len(looseEnds), 1)
+            order = np.argsort(endDistances[rows, cols], kind='stable')
+            looseEnds = np.asarray(looseEnds)
+            candidateEdges = zip(looseEnds[rows[order]].tolist(), looseEnds[cols[order]].tolist())
+        else:
+            candidateEdges = nearestCandidateEdges(points, looseEnds, k)
+        newLinked = greedyLinks(candidateEdges, parent, adjacency, linked)
+        if newLinked == linked:
+            # Every nearby end belongs to the same fragment, so look further afield
+            k = 2*k
+        linked = newLinked
+    return closeTour(adjacency)
+
+
+def heldKarpTour(distances):
+    # Exact tour by bitmask dynamic programming over the subsets of stops, starting at the
+    # last node. cost[mask, j] is the shortest path from the start through mask ending at j.
+    n = len(distances)
+    if n < 4:
+        return list(range(n))[::-1]
+    m = n-1
+    start = m
+    full = (1 << m) - 1
+    bits = 1 << np.arange(m)
+    masks = np.arange(1 << m)
+    subsetSizes = ((masks[:, None] & bits) != 0).sum(axis=1)
+    inner = distances[:m, :m]
+
+    cost = np.full((1 << m, m), np.inf)
+    parent = np.full((1 << m, m), -1, dtype=np.int64)
+    cost[bits, np.arange(m)] = distances[start, :m]
+    for size in range(2, m+1):
+        subsets = masks[subsetSizes == size]
+        for j in range(m):
+            withJ = subsets[(subsets & bits[j]) != 0]
+            candidates = cost[withJ ^ bits[j]] + inner[:, j]
+            best = np.argmin(candidates, axis=1)
+            cost[withJ, j] = candidates[np.arange(len(withJ)), best]
+            parent[withJ, j] = best
+
+    last = int(np.argmin(cost[full] + distances[:m, start]))
+    mask = full
+    tour = []
+    while last >= 0:
+        tour.append(last)
+        mask, last = mask ^ (1 << last), int(parent[mask, last])
+    tour.append(start)
+    return tour[::-1]
+
+
+def tourLength(tour, distances):
+    return float(distances[tour, np.roll(tour, -1)].sum())
+
+
+def rotateTour(tour, startNode):
+    start = tour.index(startNode)
+    return tour[start:] + tour[:start]
+
+
+def neighbourLists(distances, k):
+    # The k closest other nodes to every node, nearest first
+    candidates = distances + np.diag(np.full(len(distances), np.inf))
+    if k >= len(distances)-1:
+        return np.argsort(candidates, axis=1, kind='stable')[:, :k]
+    nearest = np.argpartition(candidates, k, axis=1)[:, :k]
+    ranked = np.argsort(np.take_along_axis(candidates, nearest, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(nearest, ranked, axis=1)
+
+
+def improveTour(tour, distances, timeBudget=ROUTE_IMPROVEMENT_BUDGET, neighbours=ROUTE_NEIGHBOURS):
+    # 2-opt and Or-opt local search driven by neighbour lists and don't-look bits,
+    # stopping once timeBudget seconds have passed. Returns (tour, before, after) in km.
+    deadline = time.time() + timeBudget
+    tour = list(tour)
+    n = len(tour)
+    before = tourLength(tour, distances)
+    if n < 5:
+        return (tour, before, before)
+
+    d = distances.tolist()
+    nearest = neighbourLists(distances, min(neighbours, n-1)).tolist()
+    position = [0]*n
+    for idx, node in enumerate(tour):
+        position[node] = idx
+
+    def succ(node):
+        return tour[(position[node]+1) % n]
+
+    def pred(node):
+        return tour[(position[node]-1) % n]
+
+    def reverse(start, end):
+        # Reverse the tour from position start forward to position end, or equivalently
+        # the complementary stretch, whichever is shorter
+        length = (end-start) % n + 1
+        if 2*length > n:
+            start, end = (end+1) % n, (start-1) % n
+            length = n - length
+        for step in range(length // 2):
+            i = (start+step) % n
+            j = (end-step) % n
+            tour[i], tour[j] = tour[j], tour[i]
+            position[tour[i]] = i
+            position[tour[j]] = j
+
+    def twoOpt(a):
+        for forward in (True, False):
+            b = succ(a) if forward else pred(a)
+            dab = d[a][b]
+            for c in nearest[a]:
+                dac = d[a][c]
+                if dac >= dab:
+                    break
+                e = succ(c) if forward else pred(c)
+                if c == b or e == a:
+                    continue
+                delta = dac + d[b][e] - dab - d[c][e]
+                if delta < -1e-9:
+                    if forward:
+                        reverse(position[b], position[c])
+                    else:
+                        reverse(position[a], position[e])
+                    return [a, b, c, e]
+        return None
+
+    def orOpt(a):
+        for segmentLength in (1, 2, 3):
+            if n - segmentLength < 3:
+                break
+            segment = [tour[(position[a]+step) % n] for step in range(segmentLength)]
+            first, last = segment[0], segment[-1]
+            previous, following = pred(first), succ(last)
+            removeGain = d[previous][first] + d[last][following] - d[previous][following]
+            for c in nearest[a]:
+                if c in segment:
+                    continue
+                # Insert as c, first..last, s or as r, last..first, c
+                s = following if c == previous else succ(c)
+                r = previous if c == following else pred(c)
+                forwardDelta = d[c][first] + d[last][s] - d[c][s] - removeGain
+                reversedDelta = d[r][last] + d[first][c] - d[r][c] - removeGain
+                if min(forwardDelta, reversedDelta) >= -1e-9:
+                    continue
+                rest = [node for node in tour if node not in segment]
+                if forwardDelta <= reversedDelta:
+                    at = rest.index(c) + 1
+                    rest[at:at] = segment
+                    touched = [previous, following, first, last, c, s]
+                else:
+                    at = rest.index(c)
+                    rest[at:at] = segment[::-1]
+                    touched = [previous, following, first, last, c, r]
+                tour[:] = rest
+                for idx, node in enumerate(tour):
+                    position[node] = idx
+                return touched
+        return None
+
+    # A node is queued exactly while its don't-look bit is clear
+    queue = deque(tour)
+    dontLook = [False]*n
+    while queue and time.time() < deadline:
+        a = queue.popleft()
+        dontLook[a] = True
+        touched = twoOpt(a) or orOpt(a)
+        if touched is None:
+            continue
+        for node in touched:
+            if dontLook[node]:
+                dontLook[node] = False
+                queue.append(node)
+
+    return (tour, before, tourLength(tour, distances))
+
+
+def nearestNeighbourTour(distances):
+    # Start at the last node and always move to the closest unvisited one
+    n = len(distances)
+    visited = np.zeros(n, dtype=bool)
+    tour = [n-1]
+    visited[n-1] = True
+    for step in range(n-1):
+        nextStop = int(np.argmin(np.where(visited, np.inf, distances[tour[-1]])))
+        tour.append(nextStop)
+        visited[nextStop] = True
+    return tour
+
+
+def christofidesTour(distances):
+    # Christofides-style tour: minimum spanning tree, plus a greedy (rather than exact)
+    # minimum-weight matching on the odd-degree nodes, walked as an Euler circuit with
+    # repeated nodes skipped
+    n = len(distances)
+    if n < 4:
+        return list(range(n))
+    # The sparse MST treats zero as "no link", so shift every link by the same amount
+    # (which leaves the tree unchanged) to keep coincident nodes connected
+    offDiagonal = distances + 1.0
+    np.fill_diagonal(offDiagonal, 0)
+    tree = minimum_spanning_tree(offDiagonal).tocoo()
+    G = nx.MultiGraph()
+    G.add_edges_from(zip(tree.row.tolist(), tree.col.tolist()))
+
+    odd = np.flatnonzero(np.bincount(np.concatenate((tree.row, tree.col)), minlength=n) % 2)
+    rows, cols = np.triu_indices(len(odd), 1)
+    order = np.argsort(distances[odd[rows], odd[cols]], kind='stable')
+    matched = set()
+    for i, j in zip(odd[rows[order]].tolist(), odd[cols[order]].tolist()):
+        if i not in matched and j not in matched:
+            G.add_edge(i, j)
+            matched.update((i, j))
+
+    tour = []
+    seen = set()
+    for start, end in nx.eulerian_circuit(G, source=0):
+        if start not in seen:
+            tour.append(start)
+            seen.add(start)
+    return tour
+
+
+def hilbertTour(coordinates, order=16):
+    # Visit nodes in the order of a Hilbert space-filling curve over their bounding box
+    points = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+    x = points[:, 1]*np.cos(np.radians(points[:, 0].mean()))
+    y = points[:, 0]
+    side = 1 << order
+    span = max(np.ptp(x), np.ptp(y)) or 1.0
+    x = ((x - x.min())/span*(side-1)).astype(np.int64)
+    y = ((y - y.min())/span*(side-1)).astype(np.int64)
+
+    index = np.zeros(len(points), dtype=np.int64)
+    s = side >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s*s*((3*rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x = np.where(flip, side-1-x, x)
+        y = np.where(flip, side-1-y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return np.argsort(index, kind='stable').tolist()
+
+
+# Route solvers, selected by name for each request or with ROUTE_SOLVER. Each takes the
+# (lat, lng) array of a day's nodes, a local search budget in seconds and their distance
+# matrix if one was already computed (otherwise None), and returns a tour.
+ROUTE_SOLVERS = {}
+
+RouteSolution = namedtuple('RouteSolution', ['tour', 'length', 'seconds', 'solver'])
+
+
+def ensureDistances(coordinates, distances):
+    return distances if distances is not None else distanceMatrix(coordinates)
+
+
+def registerSolver(name):
+    def register(solver):
+        ROUTE_SOLVERS[name] = solver
+        return solver
+    return register
+
+
+def matrixTour(distances, timeBudget):
+    # Exact tour for small node sets, otherwise greedy plus local search
+    if len(distances) <= HELD_KARP_MAX_NODES:
+        return heldKarpTour(distances)
+    tour = greedyEdgeTour(distances)
+    if timeBudget > 0:
+        tour, before, after = improveTour(tour, distances, timeBudget)
+        print("Route improved from {:.3f} km to {:.3f} km".format(before, after))
+    return tour
+
+
+@registerSolver('auto')
+def autoSolver(coordinates, timeBudget, distances):
+    # Small days are solved exactly, very large ones only look at nearby links,
+    # and everything in between uses the full greedy heuristic plus local search
+    if len(coordinates) > HELD_KARP_MAX_NODES and len(coordinates) >= CANDIDATE_GREEDY_MIN_NODES:
+        return candidateGreedyTour(coordinates)
+    return matrixTour(ensureDistances(coordinates, distances), timeBudget)
+
+
+@registerSolver('held-karp')
+def heldKarpSolver(coordinates, timeBudget, distances):
+    if len(coordinates) > HELD_KARP_MAX_NODES:
+        raise ValueError("Held-Karp is limited to {} nodes, got {}".format(HELD_KARP_MAX_NODES, len(coordinates)))
+    return heldKarpTour(ensureDistances(coordinates, distances))
+
+
+@registerSolver('greedy')
+def greedySolver(coordinates, timeBudget, distances):
+    return greedyEdgeTour(ensureDistances(coordinates, distances))
+
+
+@registerSolver('candidate-greedy')
+def candidateGreedySolver(coordinates, timeBudget, distances):
+    return candidateGreedyTour(coordinates)
+
+
+@registerSolver('nearest-neighbour')
+def nearestNeighbourSolver(coordinates, timeBudget, distances):
+    return nearestNeighbourTour(ensureDistances(coordinates, distances))
+
+
+@registerSolver('christofides')
+def christofidesSolver(coordinates, timeBudget, distances):
+    return christofidesTour(ensureDistances(coordinates, distances))
+
+
+@registerSolver('hilbert')
+def hilbertSolver(coordinates, timeBudget, distances):
+    return hilbertTour(coordinates)
+
+
+def solveRoute(coordinates, solver=None, timeBudget=None, distances=None):
+    # Run one registered solver and report the tour, its length in km and its wall time
+    if solver is None:
+        solver = ROUTE_SOLVER
+    if solver not in ROUTE_SOLVERS:
+        raise ValueError("Unknown route solver {!r}, choose from {}".format(solver, sorted(ROUTE_SOLVERS)))
+    if timeBudget is None:
+        timeBudget = ROUTE_IMPROVEMENT_BUDGET
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+
+    start = time.time()
+    tour = ROUTE_SOLVERS[solver](coordinates, timeBudget, distances)
+    seconds = time.time() - start
+    if distances is not None:
+        length = tourLength(tour, distances)
+    else:
+        length = float(pairDistances(coordinates[tour], coordinates[np.roll(tour, -1)]).sum())
+    return RouteSolution(tour, length, seconds, solver)
+
+
+def routeCost(route, distances):
+    # Length of a day visiting route in order from and back to the depot, the last node
+    depot = len(distances)-1
+    stops = [depot] + list(route) + [depot]
+    return float(distances[stops[:-1], stops[1:]].sum())
+
+
+def orderRoute(route, distances, timeBudget=0):
+    # Reorder a day's customers into the best tour found from and back to the depot
+    if len(route) < 3:
+        return list(route)
+    nodes = list(route) + [len(distances)-1]
+    tour = rotateTour(matrixTour(distances[np.ix_(nodes, nodes)], timeBudget), len(route))
+    return [nodes[stop] for stop in tour[1:]]
+
+
+def sweepRoutes(points, routes, capacity):
+    # Split the customers into routes by their bearing from the depot, the last point,
+    # starting the sweep at the widest empty wedge so no group is cut in two
+    depot = len(points)-1
+    offsets = np.asarray(points, dtype=float)[:depot] - np.asarray(points, dtype=float)[depot]
+    angles = np.arctan2(offsets[:, 1], offsets[:, 0])
+    order = np.argsort(angles, kind='stable')
+    gaps = np.diff(np.append(angles[order], angles[order[0]] + 2*np.pi))
+    order = np.roll(order, -(int(np.argmax(gaps))+1)).tolist()
+    sizes = [len(order)//routes + (1 if route < len(order) % routes else 0) for route in range(routes)]
+    if max(sizes) > capacity:
+        raise ValueError("{} customers do not fit in {} routes of {}".format(len(order), routes, capacity))
+    bounds = np.cumsum([0] + sizes).tolist()
+    return [order[bounds[route]:bounds[route+1]] for route in range(routes)]
+
+
+def relocateMove(dayRoutes, d, depot, capacity):
+    # Move one customer to the cheapest position in another route if that shortens the plan
+    for a, routeA in enumerate(dayRoutes):
+        if len(routeA) < 2:
+            continue
+        for i, customer in enumerate(routeA):
+            previous = routeA[i-1] if i > 0 else depot
+            following = routeA[i+1] if i+1 < len(routeA) else depot
+            removeGain = d[previous][customer] + d[customer][following] - d[previous][following]
+            for b, routeB in enumerate(dayRoutes):
+                if b == a or len(routeB) >= capacity:
+                    continue
+                stops = [depot] + routeB + [depot]
+                costs = [d[u][customer] + d[customer][v] - d[u][v] for u, v in zip(stops, stops[1:])]
+                position = int(np.argmin(costs))
+                if costs[position] - removeGain < -1e-9:
+                    routeA.pop(i)
+                    routeB.insert(position, customer)
+                    return (a, b)
+    return None
+
+
+def exchangeMove(dayRoutes, d, depot):
+    # Swap two customers between routes if that shortens the plan
+    for a in range(len(dayRoutes)):
+        for b in range(a+1, len(dayRoutes)):
+            routeA, routeB = dayRoutes[a], dayRoutes[b]
+            for i, first in enumerate(routeA):
+                previousA = routeA[i-1] if i > 0 else depot
+                followingA = routeA[i+1] if i+1 < len(routeA) else depot
+                for j, second in enumerate(routeB):
+                    previousB = routeB[j-1] if j > 0 else depot
+                    followingB = routeB[j+1] if j+1 < len(routeB) else depot
+                    delta = (d[previousA][second] + d[second][followingA] - d[previousA][first] - d[first][followingA]
+                             + d[previousB][first] + d[first][followingB] - d[previousB][second] - d[second][followingB])
+                    if delta < -1e-9:
+                        routeA[i], routeB[j] = second, first
+                        return (a, b)
+    return None
+
+
+def vrpRoutes(distances, points, routes, capacity, timeBudget=VRP_BUDGET):
+    # Assign customers to routes and order them together, with the last node as the shared
+    # depot: a sweep construction, then relocate and exchange moves between routes, each
+    # followed by reordering the two routes it touched, until none helps or time runs out
+    deadline = time.time() + timeBudget
+    depot = len(distances)-1
+    d = distances.tolist()
+    dayRoutes = [orderRoute(route, distances) for route in sweepRoutes(points, routes, capacity)]
+    while time.time() < deadline:
+        touched = relocateMove(dayRoutes, d, depot, capacity) or exchangeMove(dayRoutes, d, depot)
+        if touched is None:
+            break
+        for route in touched:
+            dayRoutes[route] = orderRoute(dayRoutes[route], distances)
+    return dayRoutes
+
+
+def buildTour(names, coordinates, order, distances=None):
+    # The day's route as stops in visiting order, from the first node in order back to it,
+    # with the length of every leg and the distance travelled by the end of each leg
+    stops = list(order) + [order[0]]
+    if distances is not None:
+        legs = distances[stops[:-1], stops[1:]]
+    else:
+        legs = pairDistances(coordinates[stops[:-1]], coordinates[stops[1:]])
+    return {'stops': stops,
+            'names': [names[stop] for stop in stops],
+            'legs': legs.tolist(),
+            'cumulative': np.cumsum(legs).tolist(),
+            'length': float(legs.sum())}
+
+
+def identifyTour(locationsList, propertyNode, timeBudget=None, solver=None, distances=None):
+    # Route for one day starting and ending at the property, or None when no places were picked.
+    # Stops are positions in locationsList, with the property after its last location.
+    # distances, if given, is the matrix over locationsList followed by propertyNode.
+    if(len(locationsList)==0):
+        return None
+    else:
+        extendedLocationsList = list(locationsList)
+        extendedLocationsList.append(propertyNode)
+        propertyIndex = len(extendedLocationsList)-1
+        coordinates = np.array([location[1] for location in extendedLocationsList], dtype=float)
+        if distances is None and len(coordinates) < CANDIDATE_GREEDY_MIN_NODES:
+            distances = providerMatrix(coordinates, planarDistanceMatrix(localProjection(coordinates, coordinates[propertyIndex])))
+
+        solution = solveRoute(coordinates, solver, timeBudget, distances)
+        print("Route for {} stops solved by {} in {:.1f} ms: {:.3f} km".format(
+            len(locationsList), solution.solver, solution.seconds*1000, solution.length))
+
+        names = [location[0] for location in extendedLocationsList]
+        return buildTour(names, coordinates, rotateTour(solution.tour, propertyIndex), distances)
+
+
+# Pool shared by every request handled by this process. The web app starts it while being
+# imported, before any other thread exists, since forking a process that runs threads can
+# deadlock the children. Scripts without threads get it on first use.
+routePool = None
+
+
+def startRoutePool():
+    global routePool
+    if routePool is None and ROUTE_WORKERS > 1:
+        routePool = multiprocessing.Pool(ROUTE_WORKERS)
+    return routePool
+
+
+def getRoutePool():
+    return startRoutePool()
+
+
+def identifyDayTour(job):
+    return identifyTour(*job)
+
+
+# Solved days keyed by routeCacheKey, shared by every request handled by this process
+routeCache = LRUCache(ROUTE_CACHE_SIZE)
+
+
+def routeCacheKey(locationsList, propertyNode, timeBudget, solver):
+    # The same stops in any order, with the same property and solver settings, share a key
+    stops = sorted([location[0], location[1][0], location[1][1]] for location in locationsList)
+    settings = [solver or ROUTE_SOLVER, ROUTE_IMPROVEMENT_BUDGET if timeBudget is None else timeBudget]
+    payload = json.dumps([stops, [propertyNode[0], propertyNode[1][0], propertyNode[1][1]], settings])
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+# Distance matrix over every place found for a planning session plus its property, keyed by
+# the session's id, so planning and re-planning its days only slice out sub-matrices. They are kept
+# in single precision, which is far finer than the distances themselves.
+sessionMatrices = LRUCache(SESSION_MATRIX_CACHE_BYTES, SESSION_MATRIX_TTL, sizeof=lambda matrix: matrix.nbytes)
+
+
+def newSessionId():
+    # Each step one response carries its own id, so two users planning the same trip never
+    # share a matrix or each other's tours
+    return uuid.uuid4().hex
+
+
+def sessionDistanceMatrix(coordinates, points):
+    # coordinates are every node of the session, property last, and points the same nodes
+    # projected with localProjection. Sessions too large for a full matrix get None and
+    # route from coordinates instead.
+    if len(points) >= CANDIDATE_GREEDY_MIN_NODES:
+        return None
+    return providerMatrix(coordinates, planarDistanceMatrix(points))
+
+
+def storeSessionMatrix(sessionId, distances):
+    if distances is not None:
+        sessionMatrices.put(sessionId, np.asarray(distances, dtype=np.float32))
+
+
+def sessionSubMatrix(sessionId, nodes):
+    # Distances between nodes sliced from the session matrix, or None if it is not available
+    if sessionId is None:
+        return None
+    matrix = sessionMatrices.get(sessionId)
+    if matrix is None or max(nodes) >= len(matrix):
+        return None
+    return matrix[np.ix_(nodes, nodes)].astype(float)
+
+
+def identifyTripTours(dayLists, names, coordinates, timeBudget=None, solver=None, sessionId=None):
+    # Solve each day of the trip independently, returning tours in day order. Days hold node
+    # ids, which index names and coordinates, and the last node is the property. Days solved
+    # before come from routeCache and the rest are spread over the route pool, reading their
+    # distances from the session matrix when sessionId has one.
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2).tolist()
+    propertyId = len(names)-1
+    propertyNode = [names[propertyId], tuple(coordinates[propertyId])]
+
+    # Stops are put in a canonical order so the same day planned again shares a cached tour
+    dayNodes = [sorted(dayList, key=lambda node: (names[node], coordinates[node])) + [propertyId] for dayList in dayLists]
+    dayLocations = [[[names[node], tuple(coordinates[node])] for node in nodes[:-1]] for nodes in dayNodes]
+
+    keys = [routeCacheKey(locationsList, propertyNode, timeBudget, solver) for locationsList in dayLocations]
+    tours = [routeCache.get(key) if len(locationsList) > 0 else None for key, locationsList in zip(keys, dayLocations)]
+    unsolved = [idx for idx, locationsList in enumerate(dayLocations) if len(locationsList) > 0 and tours[idx] is None]
+
+    jobs = [(dayLocations[idx], propertyNode, timeBudget, solver, sessionSubMatrix(sessionId, dayNodes[idx]))
+            for idx in unsolved]
+    if ROUTE_WORKERS <= 1 or len(jobs) <= 1:
+        solved = [identifyDayTour(job) for job in jobs]
+    else:
+        solved = getRoutePool().map(identifyDayTour, jobs)
+
+    for idx, tour in zip(unsolved, solved):
+        routeCache.put(keys[idx], tour)
+        tours[idx] = tour
+    print("Route cache: {hits} hits, {misses} misses".format(**routeCache.stats()))
+
+    # Map the tours' positions back to node ids
+    for idx, tour in enumerate(tours):
+        if tour is not None:
+            tour = dict(tour)
+            tour['stops'] = [dayNodes[idx][stop] for stop in tour['stops']]
+            tours[idx] = tour
+    return tours
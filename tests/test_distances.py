@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+import numpy as np
+
+import distances
+
+
+def road_km(origin, destination):
+    # Made-up road distance, 50 m longer going north than coming back south
+    km = (abs(origin[0]-destination[0]) + abs(origin[1]-destination[1]))*100
+    return km + (0.1 if destination[0] > origin[0] else 0.0)
+
+
+class TableHandler(BaseHTTPRequestHandler):
+    # Answers /table/v1/driving/ requests the way an OSRM server does, as set by server.mode
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        coordinates = [[float(value) for value in pair.split(',')][::-1] for pair in url.path.split('/')[-1].split(';')]
+        query = parse_qs(url.query)
+        sources = [int(idx) for idx in query['sources'][0].split(';')]
+        destinations = [int(idx) for idx in query['destinations'][0].split(';')]
+        self.server.requests.append((len(coordinates), len(sources), len(destinations)))
+        if self.server.mode == 'slow':
+            time.sleep(0.5)
+        if self.server.mode == 'error':
+            body = {'code': 'InvalidQuery', 'message': 'Too many table coordinates'}
+        else:
+            body = {'code': 'Ok', 'distances': [[None if (coordinates[i], coordinates[j]) in self.server.unroutable
+                                                 else road_km(coordinates[i], coordinates[j])*1000
+                                                 for j in destinations] for i in sources]}
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode('utf-8'))
+        except Exception:
+            # The client gave up waiting
+            pass
+
+
+class TableServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RoutedProviderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = TableServer(('127.0.0.1', 0), TableHandler)
+        threading.Thread(target=cls.server.serve_forever).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.mode = 'ok'
+        self.server.requests = []
+        self.server.unroutable = []
+        self.settings = (distances.ROUTED_DISTANCE_URL, distances.ROUTED_DISTANCE_TIMEOUT, distances.ROUTED_MATRIX_BLOCK)
+        distances.ROUTED_DISTANCE_URL = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        distances.ROUTED_DISTANCE_TIMEOUT = 0.2
+        distances.ROUTED_MATRIX_BLOCK = 4
+        distances.routedPairs.clear()
+
+        rng = np.random.RandomState(0)
+        self.coordinates = np.round(np.array([40.758, -73.985]) + rng.uniform(-0.05, 0.05, (10, 2)), 6)
+        self.straightLine = np.array([[0.0 if i == j else 1.0 for j in range(10)] for i in range(10)])
+        # Both directions are averaged, as the route solvers expect
+        self.expected = np.array([[0.0 if i == j else (road_km(origin, destination) + road_km(destination, origin))/2
+                                   for j, destination in enumerate(self.coordinates.tolist())]
+                                  for i, origin in enumerate(self.coordinates.tolist())])
+
+    def tearDown(self):
+        distances.ROUTED_DISTANCE_URL, distances.ROUTED_DISTANCE_TIMEOUT, distances.ROUTED_MATRIX_BLOCK = self.settings
+        distances.routedPairs.clear()
+
+    def routed(self):
+        return distances.providerMatrix(self.coordinates, self.straightLine, 'routed')
+
+    def test_matrix_is_fetched_in_blocks(self):
+        matrix = self.routed()
+        # 10 nodes in blocks of 4 make 3 x 3 requests, none over 8 coordinates
+        self.assertEqual(len(self.server.requests), 9)
+        self.assertTrue(all(count <= 8 and sources <= 4 and destinations <= 4
+                            for count, sources, destinations in self.server.requests))
+        self.assertTrue(np.allclose(matrix, self.expected))
+
+    def test_matrix_is_symmetric(self):
+        matrix = self.routed()
+        self.assertTrue(np.allclose(matrix, matrix.T))
+        self.assertTrue(np.allclose(np.diag(matrix), 0.0))
+
+    def test_cached_pairs_are_not_asked_for_again(self):
+        first = self.routed()
+        self.server.requests = []
+        second = self.routed()
+        self.assertEqual(self.server.requests, [])
+        self.assertTrue(np.allclose(first, second))
+
+    def test_timeout_falls_back_to_straight_lines(self):
+        self.server.mode = 'slow'
+        matrix = self.routed()
+        # The remaining blocks are skipped after the first request times out
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(np.allclose(matrix, self.straightLine))
+        # Pairs lost to a failed request are asked for again later
+        self.server.mode = 'ok'
+        self.assertTrue(np.allclose(self.routed(), self.expected))
+
+    def test_error_code_falls_back_to_straight_lines(self):
+        self.server.mode = 'error'
+        matrix = self.routed()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(np.allclose(matrix, self.straightLine))
+
+    def test_unroutable_pair_keeps_straight_line(self):
+        coordinates = self.coordinates.tolist()
+        self.server.unroutable = [(coordinates[0], coordinates[1])]
+        matrix = self.routed()
+        self.assertAlmostEqual(matrix[0][1], (1.0 + road_km(coordinates[1], coordinates[0]))/2)
+        # Pairs without a route are remembered too
+        self.server.requests = []
+        self.routed()
+        self.assertEqual(self.server.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
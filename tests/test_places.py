@@ -0,0 +1,105 @@
+import unittest
+
+import numpy as np
+
+import places
+
+
+class Response(object):
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class PlacesStub(object):
+    # Answers nearby searches from a fixed world of places, most prominent first, in pages of
+    # PLACES_PAGE_SIZE like Places does
+
+    def __init__(self, world):
+        self.world = world
+        self.requests = []
+        self.status = 'OK'
+
+    def get(self, url, timeout=None):
+        query = dict(part.split('=', 1) for part in url.split('?', 1)[1].split('&'))
+        self.requests.append(query)
+        if self.status != 'OK':
+            return Response({'status': self.status, 'results': []})
+        if 'pagetoken' in query:
+            location, radius, attraction_type, page = query['pagetoken'].split('|')
+            page = int(page)
+        else:
+            location, radius, attraction_type, page = query['location'], query['radius'], query['type'], 0
+        centre = [float(value) for value in location.split(',')]
+        candidates = [place for place in self.world if place[3] == attraction_type]
+        distances = places.distances_from(centre, [[name, (lat, lng)] for name, lat, lng, kind in candidates])
+        matches = [place for place, distance in zip(candidates, distances.tolist()) if distance <= float(radius)]
+        start = page*places.PLACES_PAGE_SIZE
+        data = {'status': 'OK', 'results': [{'name': name, 'place_id': name, 'geometry': {'location': {'lat': lat, 'lng': lng}}}
+                                            for name, lat, lng, kind in matches[start:start+places.PLACES_PAGE_SIZE]]}
+        if start + places.PLACES_PAGE_SIZE < len(matches):
+            data['next_page_token'] = '|'.join([location, radius, attraction_type, str(page+1)])
+        return Response(data)
+
+
+class TileSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Plenty of museums and parks up to 40 km around, thinning out beyond the first 10 km,
+        # listed most prominent first
+        offsets = np.vstack([rng.uniform(-0.09, 0.09, (1000, 2)), rng.uniform(-0.36, 0.36, (1000, 2))])
+        rng.shuffle(offsets)
+        self.centre = (40.7512, -73.9851)
+        self.world = [('{} {}'.format(attraction_type, idx), self.centre[0] + offset[0], self.centre[1] + offset[1], attraction_type)
+                      for idx, offset in enumerate(offsets.tolist()) for attraction_type in ('museum', 'park')]
+        self.stub = PlacesStub(self.world)
+        self.settings = (places.placesSession, places.NEXT_PAGE_DELAY, places.placesUpstream.backoff)
+        places.placesSession = self.stub
+        places.NEXT_PAGE_DELAY = 0.0
+        places.placesUpstream.backoff = 0.0
+        places.nearbyTiles.clear()
+        places.densities.clear()
+
+    def tearDown(self):
+        places.placesSession, places.NEXT_PAGE_DELAY, places.placesUpstream.backoff = self.settings
+        places.nearbyTiles.clear()
+        places.densities.clear()
+
+    def search(self, location, radius, attraction_types, totals=None):
+        # Searches every type through the tile cache, as step one does
+        for attraction_type in attraction_types:
+            records, total = places.tile_search(location, radius, attraction_type, 'key')
+            if totals is not None:
+                totals[attraction_type] = total
+            for record in records:
+                yield record
+
+    def test_tile_search_reports_results_before_filtering(self):
+        records, total = places.tile_search(self.centre, 3000, 'museum', 'key')
+        self.assertEqual(total, places.PLACES_PAGE_SIZE*places.PLACES_MAX_PAGES)
+        self.assertLess(len(records), total)
+        self.assertTrue(all(distance <= 3000 for distance in places.distances_from(self.centre, records).tolist()))
+
+    def test_adaptive_search_stops_once_tile_searches_fill_their_pages(self):
+        records = places.adaptive_search(self.search, self.centre, ['museum', 'park'], 7)
+        # One round of two pages for each type, all within the first radius
+        self.assertEqual(len(self.stub.requests), 2*places.PLACES_MAX_PAGES)
+        self.assertTrue(records)
+        self.assertLessEqual(max(places.distances_from(self.centre, records).tolist()), places.SEARCH_RADIUS)
+
+    def test_refused_search_is_not_cached(self):
+        self.stub.status = 'OVER_QUERY_LIMIT'
+        with self.assertRaises(places.PlacesStatusError):
+            places.tile_search(self.centre, 2000, 'museum', 'key')
+        self.assertEqual(places.nearbyTiles.stats()['size'], 0)
+        self.stub.status = 'OK'
+        self.assertTrue(places.tile_search(self.centre, 2000, 'museum', 'key')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import math
+import unittest
+
+from pois import EARTH_RADIUS_M, dedupe_pois, dedupe_stream, distance_m, mask_types, poi_table
+
+
+def north_of(location, metres):
+    return (location[0] + math.degrees(metres/EARTH_RADIUS_M), location[1])
+
+
+class DedupeStreamTest(unittest.TestCase):
+
+    def test_same_place_id_keeps_every_type(self):
+        table = dedupe_stream([['Louvre', (48.8606, 2.3376), 'museum', 'p1'],
+                               ['Louvre', (48.8606, 2.3376), 'art_gallery', 'p1']])
+        self.assertEqual(len(table), 1)
+        self.assertEqual(sorted(mask_types(table['types'][0])), ['art_gallery', 'museum'])
+
+    def test_same_name_nearby_is_merged_into_the_first(self):
+        start = (51.5194, -0.1270)
+        table = dedupe_stream([['British Museum', start, 'museum', 'p1'],
+                               ['british museum', north_of(start, 15), 'art_gallery', 'p2']])
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table['place_id'][0], b'p1')
+        self.assertEqual(sorted(mask_types(table['types'][0])), ['art_gallery', 'museum'])
+
+    def test_same_name_beyond_radius_is_kept(self):
+        start = (51.5194, -0.1270)
+        table = dedupe_stream([['Gift Shop', start, 'shopping_mall', 'p1'],
+                               ['Gift Shop', north_of(start, 40), 'shopping_mall', 'p2']])
+        self.assertEqual(len(table), 2)
+
+    def test_chain_of_different_venues_is_not_merged(self):
+        # Neighbours are 11 to 22 metres apart, the ends 78 metres apart
+        locations = [(52.5200, 13.4050)]
+        for gap in (11, 22, 22, 22):
+            locations.append(north_of(locations[-1], gap))
+        self.assertAlmostEqual(distance_m(locations[0], locations[-1]), 77, delta=1)
+        records = [['City Museum', locations[0], 'museum', 'p1'],
+                   ['Riverside Park', locations[1], 'park', 'p2'],
+                   ['Petting Zoo', locations[2], 'zoo', 'p3'],
+                   ['Reptile House', locations[3], 'zoo', 'p4'],
+                   ['Aviary', locations[4], 'zoo', 'p5']]
+        table = dedupe_stream(iter(records))
+        self.assertEqual(table['place_id'].tolist(), [b'p1', b'p2', b'p3', b'p4', b'p5'])
+        self.assertEqual(table['id'].tolist(), [0, 1, 2, 3, 4])
+
+    def test_chain_of_one_name_is_compared_with_its_first_poi(self):
+        locations = [(52.5200, 13.4050)]
+        for gap in (20, 20):
+            locations.append(north_of(locations[-1], gap))
+        table = dedupe_stream([['Zoo', location, 'zoo', 'p{}'.format(idx)] for idx, location in enumerate(locations)])
+        self.assertEqual(table['place_id'].tolist(), [b'p0', b'p2'])
+
+    def test_dedupe_pois_matches_stream(self):
+        table = poi_table([['Louvre', (48.8606, 2.3376), 'museum', 'p1'],
+                           ['Louvre', (48.8606, 2.3376), 'art_gallery', 'p1'],
+                           ['Tuileries', (48.8634, 2.3275), 'park', 'p2']])
+        self.assertEqual(dedupe_pois(table)['name'].tolist(), ['Louvre', 'Tuileries'])
+
+
+if __name__ == '__main__':
+    unittest.main()
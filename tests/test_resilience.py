@@ -0,0 +1,192 @@
+import threading
+import time
+import unittest
+
+from resilience import CircuitOpenError, SingleFlight, TokenBucket, Upstream
+
+
+class Flaky(object):
+    # Fails the first failures calls, then answers result
+
+    def __init__(self, failures, result='ok'):
+        self.failures = failures
+        self.result = result
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        if calls <= self.failures:
+            raise IOError("attempt {} failed".format(calls))
+        return self.result
+
+
+class UpstreamTest(unittest.TestCase):
+
+    def test_failed_attempts_are_retried(self):
+        upstream = Upstream('test', retries=2, backoff=0.001)
+        function = Flaky(2)
+        self.assertEqual(upstream.call(function), 'ok')
+        self.assertEqual(function.calls, 3)
+        self.assertEqual(upstream.stats()['retries'], 2)
+        self.assertEqual(upstream.stats()['state'], 'closed')
+
+    def test_last_error_is_raised_once_retries_run_out(self):
+        upstream = Upstream('test', retries=2, backoff=0.001)
+        function = Flaky(10)
+        with self.assertRaises(IOError) as raised:
+            upstream.call(function)
+        self.assertEqual(str(raised.exception), "attempt 3 failed")
+        self.assertEqual(function.calls, 3)
+
+    def test_slow_attempt_is_hedged_after_p95(self):
+        upstream = Upstream('test')
+        for call in range(20):
+            upstream.call(lambda: time.sleep(0.01))
+        delay = upstream.hedge_delay()
+        self.assertTrue(0.01 <= delay < 0.1)
+
+        calls = []
+        lock = threading.Lock()
+
+        def first_slow():
+            with lock:
+                calls.append(time.time())
+                first = len(calls) == 1
+            time.sleep(1.0 if first else 0.0)
+            return 'slow' if first else 'hedge'
+
+        start = time.time()
+        self.assertEqual(upstream.call(first_slow), 'hedge')
+        self.assertLess(time.time() - start, 0.5)
+        self.assertGreaterEqual(calls[1] - calls[0], delay - 0.005)
+        stats = upstream.stats()
+        self.assertEqual((stats['hedges'], stats['hedge_wins']), (1, 1))
+
+    def test_fast_attempt_is_not_hedged(self):
+        upstream = Upstream('test')
+        for call in range(20):
+            upstream.call(lambda: time.sleep(0.01))
+        upstream.call(lambda: None)
+        self.assertEqual(upstream.stats()['hedges'], 0)
+
+    def test_circuit_opens_after_consecutive_failures_and_half_opens_after_reset(self):
+        upstream = Upstream('test', retries=0, failures=5, reset=0.1)
+        function = Flaky(6)
+        for call in range(5):
+            self.assertEqual(upstream.stats()['state'], 'closed')
+            with self.assertRaises(IOError):
+                upstream.call(function)
+        self.assertEqual(upstream.stats()['state'], 'open')
+
+        # Calls fail at once while the circuit is open
+        with self.assertRaises(CircuitOpenError):
+            upstream.call(function)
+        self.assertEqual(function.calls, 5)
+        self.assertEqual(upstream.stats()['short_circuited'], 1)
+
+        # After reset one trial call is let through, and its failure opens the circuit again
+        time.sleep(0.15)
+        with self.assertRaises(IOError):
+            upstream.call(function)
+        self.assertEqual(function.calls, 6)
+        with self.assertRaises(CircuitOpenError):
+            upstream.call(function)
+
+        # A successful trial closes it
+        time.sleep(0.15)
+        self.assertEqual(upstream.call(function), 'ok')
+        self.assertEqual(upstream.stats()['state'], 'closed')
+        self.assertEqual(upstream.call(function), 'ok')
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def run_callers(self, flights, function, callers=5):
+        results = []
+        errors = []
+
+        def caller():
+            try:
+                results.append(flights.do('key', function))
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=caller) for idx in range(callers)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def wait_for_callers(self, flights, callers):
+        deadline = time.time() + 5
+        while flights.stats()['calls'] < callers and time.time() < deadline:
+            time.sleep(0.005)
+
+    def test_concurrent_callers_share_one_call(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def function():
+            calls.append(1)
+            release.wait(5)
+            return 'shared'
+
+        threads, results, errors = self.run_callers(flights, function)
+        self.wait_for_callers(flights, 5)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['shared']*5)
+        self.assertEqual(flights.stats(), {'calls': 5, 'shared': 4, 'in_flight': 0})
+
+    def test_concurrent_callers_share_one_error(self):
+        flights = SingleFlight()
+        release = threading.Event()
+
+        def function():
+            release.wait(5)
+            raise IOError("upstream down")
+
+        threads, results, errors = self.run_callers(flights, function)
+        self.wait_for_callers(flights, 5)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [])
+        self.assertEqual([str(error) for error in errors], ["upstream down"]*5)
+
+    def test_later_calls_run_again(self):
+        flights = SingleFlight()
+        function = Flaky(0)
+        flights.do('key', function)
+        flights.do('key', function)
+        self.assertEqual(function.calls, 2)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_passes_and_the_rest_wait_their_turn(self):
+        bucket = TokenBucket(20, 2)
+        start = time.time()
+        waits = [bucket.acquire() for call in range(5)]
+        elapsed = time.time() - start
+        self.assertEqual(waits[:2], [0.0, 0.0])
+        self.assertTrue(all(wait > 0 for wait in waits[2:]))
+        # Three calls beyond the burst at 20 per second take about 0.15 seconds
+        self.assertGreaterEqual(elapsed, 0.14)
+        self.assertLess(elapsed, 0.5)
+        stats = bucket.stats()
+        self.assertEqual((stats['acquired'], stats['throttled']), (5, 3))
+
+    def test_tokens_refill_over_time(self):
+        bucket = TokenBucket(50, 1)
+        bucket.acquire()
+        time.sleep(0.05)
+        self.assertEqual(bucket.acquire(), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
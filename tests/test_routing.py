@@ -0,0 +1,103 @@
+import itertools
+import unittest
+
+import numpy as np
+
+from routing import (HELD_KARP_MAX_NODES, ROUTE_SOLVERS, candidateGreedyTour, distanceMatrix, greedyEdgeTour,
+                     heldKarpTour, improveTour, solveRoute, tourLength)
+
+
+def random_coordinates(rng, n):
+    return np.array([40.758, -73.985]) + rng.uniform(-0.05, 0.05, (n, 2))
+
+
+def brute_force_length(distances):
+    n = len(distances)
+    return min(tourLength([n-1] + list(order), distances) for order in itertools.permutations(range(n-1)))
+
+
+def tour_edges(tour):
+    return set(frozenset(pair) for pair in zip(tour, tour[1:] + tour[:1]))
+
+
+def reference_greedy_edges(distances):
+    # Textbook greedy edge heuristic, as the original identifyNodesEdges built it: take links
+    # from shortest to longest unless a node would get a third link or a cycle would close
+    # early, then join the two loose ends
+    n = len(distances)
+    component = list(range(n))
+    degree = [0]*n
+    edges = set()
+    for length, i, j in sorted((distances[i][j], i, j) for i in range(n) for j in range(i+1, n)):
+        if len(edges) == n-1:
+            break
+        if degree[i] == 2 or degree[j] == 2 or component[i] == component[j]:
+            continue
+        old, new = component[i], component[j]
+        component = [new if label == old else label for label in component]
+        degree[i] += 1
+        degree[j] += 1
+        edges.add(frozenset((i, j)))
+    edges.add(frozenset(node for node in range(n) if degree[node] < 2))
+    return edges
+
+
+class SolverTest(unittest.TestCase):
+
+    def assertPermutation(self, tour, n):
+        self.assertEqual(sorted(tour), list(range(n)))
+
+    def test_held_karp_matches_brute_force(self):
+        rng = np.random.RandomState(0)
+        for n in range(2, 10):
+            for trial in range(3):
+                distances = distanceMatrix(random_coordinates(rng, n))
+                tour = heldKarpTour(distances)
+                self.assertPermutation(tour, n)
+                self.assertEqual(tour[0], n-1)
+                self.assertAlmostEqual(tourLength(tour, distances), brute_force_length(distances))
+
+    def test_greedy_matches_reference_edges(self):
+        rng = np.random.RandomState(1)
+        for trial in range(200):
+            n = rng.randint(3, 30)
+            distances = distanceMatrix(random_coordinates(rng, n))
+            tour = greedyEdgeTour(distances)
+            self.assertPermutation(tour, n)
+            self.assertEqual(tour_edges(tour), reference_greedy_edges(distances))
+
+    def test_improve_tour_never_lengthens(self):
+        rng = np.random.RandomState(2)
+        for n in (5, 20, 80):
+            distances = distanceMatrix(random_coordinates(rng, n))
+            start = list(rng.permutation(n))
+            tour, before, after = improveTour(start, distances, timeBudget=1.0)
+            self.assertPermutation(tour, n)
+            self.assertAlmostEqual(before, tourLength(start, distances))
+            self.assertAlmostEqual(after, tourLength(tour, distances))
+            self.assertLessEqual(after, before + 1e-9)
+
+    def test_candidate_greedy_joins_every_fragment(self):
+        rng = np.random.RandomState(3)
+        # Two far apart clusters leave fragments no neighbour list links up
+        coordinates = np.vstack([random_coordinates(rng, 150), random_coordinates(rng, 150) + 1.0])
+        for k in (2, 10):
+            self.assertPermutation(candidateGreedyTour(coordinates, k), len(coordinates))
+
+    def test_every_solver_returns_a_permutation(self):
+        rng = np.random.RandomState(4)
+        coordinates = random_coordinates(rng, HELD_KARP_MAX_NODES)
+        duplicates = np.vstack([coordinates[:5]]*2 + [coordinates[:3]])
+        for name in sorted(ROUTE_SOLVERS):
+            for points in (coordinates, duplicates, coordinates[:1], coordinates[:2], coordinates[:3]):
+                solution = solveRoute(points, name, timeBudget=0.01)
+                self.assertPermutation(solution.tour, len(points))
+                self.assertEqual(solution.solver, name)
+
+    def test_unknown_solver_is_refused(self):
+        with self.assertRaises(ValueError):
+            solveRoute(random_coordinates(np.random.RandomState(5), 4), 'fastest')
+
+
+if __name__ == '__main__':
+    unittest.main()